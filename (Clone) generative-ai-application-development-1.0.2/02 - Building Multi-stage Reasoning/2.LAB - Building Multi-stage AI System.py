@@ -81,34 +81,14 @@ print(f"Dataset Location:  {DA.paths.datasets}")
 
 # COMMAND ----------
 
-from datasets import load_dataset
-from pyspark.sql import functions as F
-
-# Define a persistent cache directory
-cache_dir = "/dbfs/cache/"
-
-# Load dataset from Hugging Face, limit to 50%
-dataset = load_dataset("xiyuez/red-dot-design-award-product-description", split='train[:50%]', cache_dir=cache_dir)
-
-# The dataset has product, category, and text columns
-product = dataset['product']
-category = dataset['category']
-text = dataset['text']
 vs_source_table_fullname = f"{DA.catalog_name}.{DA.schema_name}.product_text"
 
-# Create DataFrame
-df = spark.createDataFrame(zip(product, category, text), ["product", "category", "text"])
-# Save DataFrame as a Delta table
-df.write.format("delta").mode("overwrite").saveAsTable(vs_source_table_fullname)
-
-# add id column
-df = df.withColumn("id", F.monotonically_increasing_id())
-
-# Save DataFrame as a Delta table with the new schema
-df.write.mode("overwrite").option("overwriteSchema", "true").saveAsTable(vs_source_table_fullname)
-
-# Enable Change Data Feed for Delta table
-spark.sql(f"ALTER TABLE {vs_source_table_fullname} SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
+# Load dataset from Hugging Face, limit to 50%. The product, category and text columns are written in a single
+# commit, with an id derived from product and category (the same on every run) and Change Data Feed enabled.
+# The dataset has no other identifying column (no year or designer), so a repeated product and category raises.
+# The write is skipped when the table already holds this revision of the dataset.
+load_hf_dataset_table("xiyuez/red-dot-design-award-product-description", vs_source_table_fullname,
+                      key_cols=["product", "category"], split="train[:50%]", columns=["product", "category", "text"])
 
 # COMMAND ----------
 
@@ -130,14 +110,16 @@ spark.sql(f"ALTER TABLE {vs_source_table_fullname} SET TBLPROPERTIES (delta.enab
 # assign vs search endpoint by username
 vs_endpoint_prefix = "vs_endpoint_"
 vs_endpoint_fallback = "vs_endpoint_fallback"
-vs_endpoint_name = vs_endpoint_prefix+str(get_fixed_integer(DA.unique_name("_")))
-print(f"Vector Endpoint name: {vs_endpoint_name}. In case of any issues, replace variable `vs_endpoint_name` with `vs_endpoint_fallback` in demos and labs.")
+# an endpoint that already hosts the index is kept
+vs_index_table_fullname = f"{DA.catalog_name}.{DA.schema_name}.product_embeddings"
+vs_endpoint_name = assign_vs_endpoint(DA.unique_name("_"), prefix=vs_endpoint_prefix, fallback=vs_endpoint_fallback,
+                                      index_names=vs_index_table_fullname)
+print(f"Vector Endpoint name: {vs_endpoint_name}. If the assigned endpoint isn't online, `vs_endpoint_fallback` is used automatically.")
 
 # COMMAND ----------
 
 from databricks.vector_search.client import VectorSearchClient
 # endpoint and table names
-vs_index_table_fullname = f"{DA.catalog_name}.{DA.schema_name}.product_embeddings"
 vs_source_table_fullname = f"{DA.catalog_name}.{DA.schema_name}.product_text"
 
 # create compute endpoint
@@ -175,19 +175,22 @@ print(chain.invoke({"genre":"romance", "actor":"Brad Pitt"}))
 # assign vs search endpoint by username
 vs_endpoint_prefix = "vs_endpoint_"
 vs_endpoint_fallback = "vs_endpoint_fallback"
-vs_endpoint_name = vs_endpoint_prefix+str(get_fixed_integer(DA.unique_name("_")))
-print(f"Vector Endpoint name: {vs_endpoint_name}. In case of any issues, replace variable `vs_endpoint_name` with `vs_endpoint_fallback` in demos and labs.")
+# an endpoint that already hosts the index is kept
+vs_index_table_fullname = f"{DA.catalog_name}.{DA.schema_name}.dais_embeddings"
+vs_endpoint_name = assign_vs_endpoint(DA.unique_name("_"), prefix=vs_endpoint_prefix, fallback=vs_endpoint_fallback,
+                                      index_names=vs_index_table_fullname)
+print(f"Vector Endpoint name: {vs_endpoint_name}. If the assigned endpoint isn't online, `vs_endpoint_fallback` is used automatically.")
 
 # COMMAND ----------
 
 from pyspark.sql import functions as F
 
-vs_index_table_fullname = f"{DA.catalog_name}.{DA.schema_name}.dais_embeddings"
 source_table_fullname = f"{DA.catalog_name}.{DA.schema_name}.dais_text"
 
 # load dataset and compute embeddings
 df = spark.read.parquet(f"{DA.paths.datasets}/dais/dais23_talks.parquet")
-df = df.withColumn("id", F.monotonically_increasing_id())
+# a talk is identified by its title and speakers, so its id survives edits to the abstract; a repeated key raises
+df = add_stable_id(df, [c for c in ["Title", "Speakers"] if c in df.columns])
 #df = df.withColumn("embedding", get_embedding("Abstract"))
 df.write.mode("overwrite").option("overwriteSchema", "true").saveAsTable(source_table_fullname)
 
@@ -0,0 +1,736 @@
+# Databricks notebook source
+# Process-wide state shared by every embedding UDF invocation running in the same Python worker.
+# Notebook globals are pickled by value into each task, so anything that has to outlive a single
+# Arrow batch (clients, connection pools, counters) lives on a module registered in sys.modules.
+import sys
+import threading
+import types
+
+def _embedding_worker_state():
+    state = sys.modules.get("_dbacademy_embedding_state")
+    if state is None:
+        candidate = types.ModuleType("_dbacademy_embedding_state")
+        candidate.lock = threading.RLock()
+        candidate.clients = {}
+        candidate.counters = {}
+        state = sys.modules.setdefault("_dbacademy_embedding_state", candidate)
+    return state
+
+# COMMAND ----------
+
+# Embedding metrics are summed across all executors with a Spark accumulator and also kept per
+# process, so they can be read on the driver after an action: get_embedding_metrics()
+from pyspark.accumulators import AccumulatorParam
+
+class _CounterAccumulatorParam(AccumulatorParam):
+    def zero(self, value):
+        return {}
+
+    def addInPlace(self, value1, value2):
+        for name, count in value2.items():
+            value1[name] = value1.get(name, 0) + count
+        return value1
+
+try:
+    _embedding_metrics = spark.sparkContext.accumulator({}, _CounterAccumulatorParam())
+except Exception:
+    # Shared access mode clusters don't expose the SparkContext, metrics then stay per process
+    _embedding_metrics = None
+
+def _record_embedding_metrics(**counts):
+    counts = {name: count for name, count in counts.items() if count}
+    if not counts:
+        return
+    state = _embedding_worker_state()
+    with state.lock:
+        for name, count in counts.items():
+            state.counters[name] = state.counters.get(name, 0) + count
+    if _embedding_metrics is not None:
+        _embedding_metrics.add(counts)
+
+def get_embedding_metrics():
+    if _embedding_metrics is not None:
+        metrics = dict(_embedding_metrics.value)
+    else:
+        state = _embedding_worker_state()
+        with state.lock:
+            metrics = dict(state.counters)
+    if metrics.get("dedupe_rows"):
+        metrics["dedupe_savings_ratio"] = 1 - metrics.get("dedupe_unique_texts", 0) / metrics["dedupe_rows"]
+    return metrics
+
+def reset_embedding_metrics():
+    if _embedding_metrics is not None:
+        _embedding_metrics.value = {}
+    state = _embedding_worker_state()
+    with state.lock:
+        state.counters.clear()
+
+# COMMAND ----------
+
+class PooledDeployClient:
+    """
+    Minimal model serving client that reuses keep-alive HTTP connections across requests.
+    Credentials are resolved on every request the same way mlflow's "databricks" deployment client does it,
+    so rotated tokens and refreshed OAuth (databricks-sdk) credentials are picked up by long-lived workers.
+    """
+    def __init__(self, target_uri="databricks", max_connections=16, timeout=120):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.target_uri = target_uri
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._connections_reported = 0
+        self._sdk_configs = {}
+
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self._session = requests.Session()
+        self._session.mount("https://", self._adapter)
+        self._session.mount("http://", self._adapter)
+
+    def _sdk_config(self, profile):
+        # The sdk config caches and refreshes its own OAuth tokens, so it is kept across requests
+        with self._lock:
+            config = self._sdk_configs.get(profile)
+            if config is None:
+                from databricks.sdk.config import Config
+                config = self._sdk_configs[profile] = Config(profile=profile)
+        return config
+
+    def _request_options(self):
+        from mlflow.utils.databricks_utils import get_databricks_host_creds
+
+        host_creds = get_databricks_host_creds(self.target_uri)
+        host, options = host_creds.host, {"headers": {}}
+        if host_creds.token:
+            options["headers"]["Authorization"] = f"Bearer {host_creds.token}"
+        elif host_creds.username and host_creds.password:
+            options["auth"] = (host_creds.username, host_creds.password)
+        elif getattr(host_creds, "use_databricks_sdk", False):
+            config = self._sdk_config(getattr(host_creds, "databricks_auth_profile", None))
+            host = host or config.host
+            options["headers"].update(config.authenticate())
+        if host_creds.ignore_tls_verification:
+            options["verify"] = False
+        elif host_creds.server_cert_path:
+            options["verify"] = host_creds.server_cert_path
+        return host.rstrip("/"), options
+
+    def connections_opened(self):
+        pools = self._adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def predict(self, endpoint, inputs):
+        host, options = self._request_options()
+        response = self._session.post(f"{host}/serving-endpoints/{endpoint}/invocations",
+                                      json=inputs, timeout=self.timeout, **options)
+        with self._lock:
+            opened = self.connections_opened()
+            new_connections = opened - self._connections_reported
+            self._connections_reported = opened
+        _record_embedding_metrics(requests=1, connections_opened=new_connections)
+        if not response.ok:
+            # Keep the endpoint's explanation, raise_for_status() only reports the status line
+            import requests
+            raise requests.HTTPError(f"{response.status_code} {response.reason} for {endpoint}: {response.text[:1000]}",
+                                     response=response)
+        return response.json()
+
+def get_pooled_deploy_client(target_uri="databricks", max_connections=16):
+    # One client per target and per Python worker, shared by every UDF call in that process
+    state = _embedding_worker_state()
+    with state.lock:
+        client = state.clients.get(target_uri)
+        if client is None or client.max_connections < max_connections:
+            client = PooledDeployClient(target_uri, max_connections=max_connections)
+            state.clients[target_uri] = client
+            _record_embedding_metrics(clients_opened=1)
+    return client
+
+# COMMAND ----------
+
+import random
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from pyspark.sql.functions import pandas_udf
+
+class _AdaptiveLimiter:
+    """
+    Caps the number of requests in flight. The cap is halved when the endpoint throttles us
+    (429/503) and grows back by one after a streak of successful requests.
+    """
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self.limit = max_in_flight
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                if self.limit > 1:
+                    self.limit = max(1, self.limit // 2)
+                    _record_embedding_metrics(concurrency_reductions=1)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_in_flight:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+def _is_throttled(error):
+    response = getattr(error, "response", None)
+    return response is not None and response.status_code in (429, 503)
+
+def _is_transient(error):
+    import requests
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and (response.status_code in (408, 429) or response.status_code >= 500)
+
+def _is_input_error(error):
+    # The endpoint rejected what was sent (bad text, payload too large), as opposed to failing to serve it
+    response = getattr(error, "response", None)
+    return response is not None and 400 <= response.status_code < 500 and response.status_code not in (408, 429)
+
+def _backoff_delay(error, attempt):
+    # Honour Retry-After, otherwise exponential backoff with full jitter so retries don't synchronize
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return random.uniform(0, min(30.0, 0.5 * 2 ** attempt))
+
+def _embed_batches(client, endpoint, batches, max_in_flight=1, max_retries=8, on_error="raise"):
+    # Returns the embeddings of all batches in input order as one contiguous (rows, dim) float32 block,
+    # plus one error message (or None) per row, keeping at most max_in_flight requests open.
+    # Transient errors are retried and raise once retries run out. With on_error="null" a batch the endpoint
+    # rejects as a bad request is bisected until only the offending rows are left, and those get a NaN vector
+    # and their error message.
+    limiter = _AdaptiveLimiter(max_in_flight)
+
+    def request_embeddings(batch):
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                response = client.predict(endpoint=endpoint, inputs={"input": batch})
+            except Exception as e:
+                throttled = _is_throttled(e)
+                limiter.release(throttled=throttled)
+                if not _is_transient(e) or attempt >= max_retries:
+                    raise
+                _record_embedding_metrics(retried_requests=1, throttled_requests=int(throttled))
+                time.sleep(_backoff_delay(e, attempt))
+                attempt += 1
+                continue
+            limiter.release()
+            return np.array([e['embedding'] for e in response['data']], dtype=np.float32)
+
+    def embed_batch(batch):
+        # List of (block or None, errors) segments covering the batch in order
+        try:
+            return [(request_embeddings(batch), [None] * len(batch))]
+        except Exception as e:
+            # Only a rejected input can be narrowed down to rows, anything else (connection errors, timeouts,
+            # 5xx or 429 after all retries) is an outage and fails the job instead of writing null embeddings
+            if on_error == "raise" or not _is_input_error(e):
+                raise
+            if len(batch) == 1:
+                _record_embedding_metrics(failed_inputs=1)
+                return [(None, [f"{type(e).__name__}: {e}"])]
+            _record_embedding_metrics(bisections=1)
+            middle = len(batch) // 2
+            return embed_batch(batch[:middle]) + embed_batch(batch[middle:])
+
+    if max_in_flight <= 1 or len(batches) <= 1:
+        results = [embed_batch(batch) for batch in batches]
+    else:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            results = list(executor.map(embed_batch, batches))  # map keeps the input order
+
+    segments = [segment for batch_segments in results for segment in batch_segments]
+    dim = next((block.shape[1] for block, _ in segments if block is not None), 0)
+    blocks = [block if block is not None else np.full((len(errors), dim), np.nan, dtype=np.float32)
+              for block, errors in segments]
+    errors = [error for _, segment_errors in segments for error in segment_errors]
+    if not blocks:
+        return np.empty((0, 0), dtype=np.float32), errors
+    return np.concatenate(blocks), errors
+
+# COMMAND ----------
+
+# Embedding backends. Everything above the HTTP layer (batching, dedupe, caching, UDFs) only needs
+# embed_batches(batches) -> ((rows, dim) float32 block, per-row errors), so a local backend with the
+# same output shape can stand in for the serving endpoint in offline runs, tests and benchmarks.
+import zlib
+
+class ServingEndpointBackend:
+    """
+    Embeds texts with a Databricks model serving endpoint through the pooled client.
+    """
+    def __init__(self, endpoint="databricks-bge-large-en", target_uri="databricks"):
+        self.endpoint = endpoint
+        self.target_uri = target_uri
+        self.name = endpoint
+
+    def prepare(self, max_in_flight=1):
+        return get_pooled_deploy_client(self.target_uri, max_connections=max(16, max_in_flight))
+
+    def embed_batches(self, batches, max_in_flight=1, on_error="raise"):
+        client = self.prepare(max_in_flight)
+        return _embed_batches(client, self.endpoint, batches, max_in_flight=max_in_flight, on_error=on_error)
+
+class HashingEmbeddingBackend:
+    """
+    Deterministic local backend: signed feature hashing of lowercased words and word bigrams into
+    `dim` buckets, L2 normalized. No network and no model, same output shape as bge-large-en.
+    """
+    def __init__(self, dim=1024):
+        self.dim = dim
+        self.name = f"local-hashing-{dim}"
+
+    def prepare(self, max_in_flight=1):
+        return None
+
+    def _features(self, text):
+        words = re.findall(r"\w+", text.lower())
+        return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+    def embed_batches(self, batches, max_in_flight=1, on_error="raise"):
+        texts = [text for batch in batches for text in batch]
+        block = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text or ""):
+                # crc32 is stable across processes, unlike Python's salted hash()
+                hashed = zlib.crc32(feature.encode("utf-8"))
+                block[row, hashed % self.dim] += 1.0 if hashed & 0x80000000 else -1.0
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        np.divide(block, norms, out=block, where=norms > 0)
+        _record_embedding_metrics(local_embeddings=len(texts))
+        return block, [None] * len(texts)
+
+# COMMAND ----------
+
+import re
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text):
+    # Fast WordPiece-style estimate: one token per punctuation mark or short word, long words split
+    # every ~6 characters, plus the [CLS]/[SEP] tokens the model adds to every input
+    return 2 + sum(1 + (len(token) - 1) // 6 for token in _TOKEN_PATTERN.findall(text))
+
+def _pack_batches(texts, max_batch_size=150, max_batch_tokens=None, token_estimator=None):
+    # Greedily packs consecutive texts into batches of at most max_batch_size inputs and, when a
+    # budget is set, at most max_batch_tokens estimated tokens (a longer single text gets its own batch)
+    if not max_batch_tokens:
+        batches = [texts[i:i + max_batch_size] for i in range(0, len(texts), max_batch_size)]
+        _record_batch_metrics(batches)
+        return batches
+
+    token_estimator = token_estimator or estimate_tokens
+    batches, batch_tokens = [], []
+    batch, tokens_in_batch = [], 0
+    for text in texts:
+        tokens = token_estimator(text)
+        if batch and (len(batch) >= max_batch_size or tokens_in_batch + tokens > max_batch_tokens):
+            batches.append(batch)
+            batch_tokens.append(tokens_in_batch)
+            batch, tokens_in_batch = [], 0
+        batch.append(text)
+        tokens_in_batch += tokens
+    if batch:
+        batches.append(batch)
+        batch_tokens.append(tokens_in_batch)
+    _record_batch_metrics(batches, batch_tokens)
+    return batches
+
+def _record_batch_metrics(batches, batch_tokens=None):
+    # Batch sizes are reported as a power-of-two histogram: batch_size_le_1, _le_2, ... _le_256
+    histogram = {}
+    for batch in batches:
+        bucket = f"batch_size_le_{1 << (len(batch) - 1).bit_length()}"
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+    _record_embedding_metrics(batches=len(batches), batch_inputs=sum(len(batch) for batch in batches),
+                              batch_tokens_estimated=sum(batch_tokens or []), **histogram)
+
+def _embed_texts(texts, endpoint="databricks-bge-large-en", max_batch_size=150, max_in_flight=1,
+                 max_batch_tokens=None, token_estimator=None, dedupe=True, on_error="raise", backend=None):
+    # Returns a (rows, dim) float32 block and one error message (or None) per row
+    texts = list(texts)
+    missing = np.array([text is None or (isinstance(text, float) and np.isnan(text)) for text in texts], dtype=bool)
+    if missing.any():
+        # Null texts aren't sent, their rows come back as null embeddings
+        block, present_errors = _embed_texts([text for text, null in zip(texts, missing) if not null], endpoint,
+                                             max_batch_size, max_in_flight, max_batch_tokens, token_estimator,
+                                             dedupe=dedupe, on_error=on_error, backend=backend)
+        full = np.full((len(texts), block.shape[1]), np.nan, dtype=np.float32)
+        full[~missing] = block
+        present_errors = iter(present_errors)
+        return full, ["null input text" if null else next(present_errors) for null in missing]
+
+    if dedupe:
+        # Embed each distinct normalized text once and fan the vectors back out to every row. The normalized
+        # text is sent even without duplicates, so a string gets the same vector in every partition.
+        codes, unique_texts = pd.factorize(pd.Series(texts, dtype=object).map(normalize_embedding_text))
+        _record_embedding_metrics(dedupe_rows=len(texts), dedupe_unique_texts=len(unique_texts))
+        block, errors = _embed_texts(list(unique_texts), endpoint, max_batch_size, max_in_flight,
+                                     max_batch_tokens, token_estimator, dedupe=False, on_error=on_error,
+                                     backend=backend)
+        return block[codes], [errors[code] for code in codes]
+
+    backend = backend or ServingEndpointBackend(endpoint)
+
+    # Splitting the contents into batches, since the embedding model takes at most 150 inputs per request.
+    batches = _pack_batches(texts, max_batch_size, max_batch_tokens, token_estimator)
+    return backend.embed_batches(batches, max_in_flight=max_in_flight, on_error=on_error)
+
+def make_get_embedding(endpoint="databricks-bge-large-en", max_batch_size=150, max_in_flight=1,
+                       max_batch_tokens=None, token_estimator=None, output="array", dedupe=True,
+                       on_error="raise", backend=None):
+    """
+    Build a pandas UDF that embeds a text column with a model serving endpoint, or with another
+    embedding backend such as HashingEmbeddingBackend() for offline runs.
+    max_in_flight > 1 keeps that many batches in flight per partition (adapting down on 429/503).
+    max_batch_tokens packs each request up to an estimated token budget (never above max_batch_size inputs).
+    output="binary" returns each vector as raw little-endian float32 bytes instead of array<float>.
+    dedupe embeds identical texts (after whitespace/unicode normalization) only once per partition.
+    on_error="null" isolates rows the endpoint keeps rejecting instead of failing the task: the UDF then
+    returns a struct<embedding, error> with a null embedding and the error message for those rows.
+    """
+    embed_options = dict(endpoint=endpoint, max_batch_size=max_batch_size, max_in_flight=max_in_flight,
+                         max_batch_tokens=max_batch_tokens, token_estimator=token_estimator, dedupe=dedupe,
+                         on_error=on_error, backend=backend)
+    if output not in ("array", "binary"):
+        raise ValueError(f"Unknown embedding output {output!r}, expected 'array' or 'binary'")
+    if on_error not in ("raise", "null"):
+        raise ValueError(f"Unknown on_error {on_error!r}, expected 'raise' or 'null'")
+
+    embedding_type = "binary" if output == "binary" else "array<float>"
+    if on_error == "null":
+        @pandas_udf(f"embedding {embedding_type}, error string")
+        def _get_embedding(contents: pd.Series) -> pd.DataFrame:
+            return _to_embedding_output(*_embed_texts(contents.tolist(), **embed_options), output, on_error)
+    else:
+        @pandas_udf(embedding_type)
+        def _get_embedding(contents: pd.Series) -> pd.Series:
+            return _to_embedding_output(*_embed_texts(contents.tolist(), **embed_options), output, on_error)
+
+    return _get_embedding
+
+def _to_embedding_output(block, errors, output="array", on_error="raise"):
+    if output == "binary":
+        block = block.astype("<f4", copy=False)
+        embeddings = [row.tobytes() if error is None else None for row, error in zip(block, errors)]
+    else:
+        # Rows are float32 views into one block, Arrow converts them without boxing Python floats
+        embeddings = [row if error is None else None for row, error in zip(block, errors)]
+    embeddings = pd.Series(embeddings, dtype=object)
+    if on_error == "null":
+        return pd.DataFrame({"embedding": embeddings, "error": pd.Series(errors, dtype=object)})
+    return embeddings
+
+# COMMAND ----------
+
+from collections import deque
+from typing import Iterator
+
+def make_get_embedding_iter(endpoint="databricks-bge-large-en", max_batch_size=150, max_in_flight=1,
+                            max_batch_tokens=None, token_estimator=None, output="array", on_error="raise",
+                            prefetch=1, partition_cache_size=10000, backend=None):
+    """
+    Iterator-of-batches variant of make_get_embedding. The client, token estimator and an in-memory
+    cache of already embedded texts are set up once per partition, and up to `prefetch` requests are
+    sent ahead while the previous batch is decoded and handed back to Spark.
+    """
+    if output not in ("array", "binary"):
+        raise ValueError(f"Unknown embedding output {output!r}, expected 'array' or 'binary'")
+    if on_error not in ("raise", "null"):
+        raise ValueError(f"Unknown on_error {on_error!r}, expected 'raise' or 'null'")
+    backend = backend or ServingEndpointBackend(endpoint)
+    embed_options = dict(max_batch_size=max_batch_size, max_in_flight=max_in_flight,
+                         max_batch_tokens=max_batch_tokens, token_estimator=token_estimator or estimate_tokens,
+                         dedupe=False, on_error=on_error, backend=backend)
+    embedding_type = "binary" if output == "binary" else "array<float>"
+    return_type = f"embedding {embedding_type}, error string" if on_error == "null" else embedding_type
+
+    @pandas_udf(return_type)
+    def _get_embedding_iter(batches: Iterator[pd.Series]) -> Iterator[pd.Series]:
+        backend.prepare(max_in_flight)
+        partition_cache = {}
+
+        def embed(contents):
+            # Only texts not seen earlier in this partition are sent to the endpoint
+            keys = [normalize_embedding_text(text) if isinstance(text, str) else None for text in contents.tolist()]
+            misses = [key for key in dict.fromkeys(keys) if key is not None and key not in partition_cache]
+            fresh = {}
+            if misses:
+                block, errors = _embed_texts(misses, **embed_options)
+                fresh = dict(zip(misses, zip(block, errors)))
+                for key, (row, error) in fresh.items():
+                    if error is None and len(partition_cache) < partition_cache_size:
+                        partition_cache[key] = row
+            _record_embedding_metrics(dedupe_rows=len(keys), dedupe_unique_texts=len(misses))
+
+            # Null texts aren't sent, their rows come back as null embeddings
+            results = [(None, "null input text") if key is None else fresh[key] if key in fresh
+                       else (partition_cache[key], None) for key in keys]
+            if not results:
+                return _to_embedding_output(np.empty((0, 0), dtype=np.float32), [], output, on_error)
+            dim = next((len(row) for row, _ in results if row is not None), 0)
+            block = np.stack([row if row is not None else np.full(dim, np.nan, dtype=np.float32) for row, _ in results])
+            return _to_embedding_output(block, [error for _, error in results], output, on_error)
+
+        # A single worker thread sends the next request while this thread yields the previous result
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = deque()
+            for contents in batches:
+                pending.append(executor.submit(embed, contents))
+                if len(pending) > prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    return _get_embedding_iter
+
+# COMMAND ----------
+
+# Content-addressed embedding cache: a Delta side table keyed by sha256(endpoint, normalized text).
+# The lookup is a join in the query plan, so only texts missing from the cache reach the endpoint.
+import hashlib
+import re
+import unicodedata
+from pyspark.sql import functions as F
+
+def normalize_embedding_text(text):
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+def embedding_cache_key(endpoint, text):
+    return hashlib.sha256(f"{endpoint}\x00{normalize_embedding_text(text)}".encode("utf-8")).hexdigest()
+
+def _make_embedding_cache_key_udf(endpoint):
+    @pandas_udf("string")
+    def _embedding_cache_key(contents: pd.Series) -> pd.Series:
+        return contents.map(lambda text: embedding_cache_key(endpoint, text), na_action="ignore")
+    return _embedding_cache_key
+
+def create_embedding_cache_table(cache_table):
+    spark.sql(f"""CREATE TABLE IF NOT EXISTS {cache_table}
+                  (key STRING, endpoint STRING, embedding ARRAY<FLOAT>, created_at TIMESTAMP)""")
+
+def add_embeddings(df, source_col, embedding_col="embedding", cache_table=None,
+                   endpoint="databricks-bge-large-en", embedding_udf=None, backend=None):
+    """
+    Add an embedding column computed from source_col. When a cache_table is given, texts already
+    embedded with the same endpoint are read from it and only the misses are sent to the endpoint.
+    """
+    from delta.tables import DeltaTable
+
+    if backend is not None:
+        endpoint = backend.name  # cache entries are keyed by the backend that produced them
+    embedding_udf = embedding_udf or make_get_embedding(endpoint, backend=backend)
+    if cache_table is None:
+        return df.withColumn(embedding_col, embedding_udf(source_col))
+
+    create_embedding_cache_table(cache_table)
+    keyed = df.withColumn("_cache_key", _make_embedding_cache_key_udf(endpoint)(F.col(source_col)))
+    cached = (spark.table(cache_table)
+              .where(F.col("endpoint") == endpoint)
+              .select(F.col("key").alias("_cache_key"), "embedding"))
+
+    # Embed each missing text once and add it to the cache
+    misses = (keyed.where(F.col("_cache_key").isNotNull())
+              .select("_cache_key", source_col)
+              .join(cached, "_cache_key", "left_anti")
+              .dropDuplicates(["_cache_key"]))
+    new_entries = misses.select(F.col("_cache_key").alias("key"),
+                                F.lit(endpoint).alias("endpoint"),
+                                embedding_udf(source_col).alias("embedding"),
+                                F.current_timestamp().alias("created_at"))
+    (DeltaTable.forName(spark, cache_table).alias("c")
+        .merge(new_entries.alias("n"), "c.key = n.key")
+        .whenNotMatchedInsertAll(condition="n.embedding IS NOT NULL")
+        .execute())
+
+    metrics = DeltaTable.forName(spark, cache_table).history(1).collect()[0]["operationMetrics"] or {}
+    cache_misses = int(metrics.get("numTargetRowsInserted", 0))
+    unique_texts = keyed.select("_cache_key").where(F.col("_cache_key").isNotNull()).distinct().count()
+    _record_embedding_metrics(cache_hits=unique_texts - cache_misses, cache_misses=cache_misses)
+    print(f"Embedding cache {cache_table}: {unique_texts - cache_misses} hits, {cache_misses} misses")
+
+    return (keyed.join(cached.withColumnRenamed("embedding", embedding_col), "_cache_key", "left")
+                 .drop("_cache_key"))
+
+# COMMAND ----------
+
+# Zero-copy Arrow path: mapInArrow hands us Arrow record batches and takes Arrow arrays back, so the
+# float32 block from the endpoint becomes the values buffer of the output column without per-row copies.
+import pyarrow as pa
+
+def _embedding_block_to_arrow(block, output="array", errors=None):
+    block = np.ascontiguousarray(block, dtype="<f4")
+    rows, dim = block.shape
+    failed = np.array([error is not None for error in errors] if errors else [False] * rows, dtype=bool)
+    if rows == 0:
+        return pa.array([], type=pa.binary() if output == "binary" else pa.list_(pa.float32()))
+    if output == "binary":
+        if failed.any():
+            return pa.array([None if fail else row.tobytes() for row, fail in zip(block, failed)], type=pa.binary())
+        offsets = np.arange(rows + 1, dtype=np.int32) * (dim * 4)
+        return pa.Array.from_buffers(pa.binary(), rows, [None, pa.py_buffer(offsets), pa.py_buffer(block)])
+    # Spark reads array<float> as an Arrow list over the same values buffer. Every row keeps its own dim-wide
+    # slot and rows the endpoint rejected are marked null through the validity mask, not the offsets.
+    offsets = pa.array(np.arange(rows + 1, dtype=np.int32) * dim)
+    return pa.ListArray.from_arrays(offsets, pa.array(block.reshape(-1)), mask=pa.array(failed))
+
+def embed_dataframe_arrow(df, source_col, embedding_col="embedding", output="array", **embed_options):
+    """
+    Add an embedding column with mapInArrow instead of a pandas UDF. output="array" produces
+    array<float>, output="binary" raw little-endian float32 vectors (see embedding_vectors_from_binary).
+    With on_error="null" rejected rows get a null embedding and an <embedding_col>_error message.
+    """
+    from pyspark.sql.types import ArrayType, BinaryType, FloatType, StringType, StructField, StructType
+
+    spark_type = BinaryType() if output == "binary" else ArrayType(FloatType())
+    with_errors = embed_options.get("on_error") == "null"
+    fields = [StructField(embedding_col, spark_type)]
+    if with_errors:
+        fields.append(StructField(f"{embedding_col}_error", StringType()))
+    schema = StructType(df.schema.fields + fields)
+
+    def embed_record_batches(record_batches):
+        for record_batch in record_batches:
+            texts = record_batch.column(source_col).to_pylist()
+            block, errors = _embed_texts(texts, **embed_options)
+            columns = [_embedding_block_to_arrow(block, output, errors)]
+            if with_errors:
+                columns.append(pa.array(errors, type=pa.string()))
+            yield pa.RecordBatch.from_arrays(record_batch.columns + columns,
+                                             names=record_batch.schema.names + [field.name for field in fields])
+
+    return df.mapInArrow(embed_record_batches, schema)
+
+def embedding_vectors_from_binary(values, dim=1024):
+    # Decodes a column of raw little-endian float32 vectors back into a (rows, dim) NumPy block
+    return np.frombuffer(b"".join(values), dtype="<f4").reshape(-1, dim)
+
+# COMMAND ----------
+
+# LangChain adapter so the same backends can replace DatabricksEmbeddings (e.g. in DatabricksVectorSearch)
+try:
+    from langchain_core.embeddings import Embeddings
+except ImportError:
+    Embeddings = object  # LangChain is only installed by the notebooks that use it
+
+class BackendEmbeddings(Embeddings):
+    """
+    LangChain Embeddings backed by an embedding backend, e.g. BackendEmbeddings(HashingEmbeddingBackend())
+    as an offline stand-in for DatabricksEmbeddings(endpoint="databricks-bge-large-en").
+    """
+    def __init__(self, backend=None, max_batch_size=150, max_in_flight=1):
+        self.backend = backend or ServingEndpointBackend()
+        self.max_batch_size = max_batch_size
+        self.max_in_flight = max_in_flight
+
+    def embed_documents(self, texts):
+        block, _ = _embed_texts(list(texts), max_batch_size=self.max_batch_size,
+                                max_in_flight=self.max_in_flight, backend=self.backend)
+        return block.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def benchmark_embedding_throughput(texts, backend=None, repeat=3, **embed_options):
+    """
+    Time _embed_texts over `texts` and return the best rows/second. With HashingEmbeddingBackend()
+    this measures the batching/dedupe/decode pipeline without any network.
+    """
+    backend = backend or HashingEmbeddingBackend()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _embed_texts(list(texts), backend=backend, **embed_options)
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(f"{backend.name}: {len(texts)} texts in {best:.3f}s ({len(texts) / best:,.0f} rows/s)")
+    return len(texts) / best
+
+# COMMAND ----------
+
+# Quantized embedding storage. int8 keeps one symmetric scale per vector (value = q * scale), binary
+# keeps the sign bits plus the mean magnitude (value = +/-scale). Both are stored as a binary column
+# next to a float scale column, 4x and 32x smaller than array<float>.
+EMBEDDING_STORAGE_TYPES = ("float32", "int8", "binary")
+
+def quantize_embeddings(block, method="int8"):
+    block = np.asarray(block, dtype=np.float32)
+    if method == "int8":
+        scales = np.abs(block).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.round(block / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    if method == "binary":
+        return np.packbits(block > 0, axis=1), np.abs(block).mean(axis=1).astype(np.float32)
+    raise ValueError(f"Unknown quantization {method!r}, expected 'int8' or 'binary'")
+
+def dequantize_embeddings(quantized, scales, method="int8", dim=1024):
+    if method == "int8":
+        return np.asarray(quantized, dtype=np.int8).astype(np.float32) * scales[:, None]
+    if method == "binary":
+        signs = np.unpackbits(np.asarray(quantized, dtype=np.uint8), axis=1, count=dim).astype(np.float32) * 2 - 1
+        return signs * scales[:, None]
+    raise ValueError(f"Unknown quantization {method!r}, expected 'int8' or 'binary'")
+
+def quantize_embedding_column(df, embedding_col="embedding", method="int8"):
+    """
+    Add <embedding_col>_q (int8 bytes or packed sign bits) and <embedding_col>_scale columns.
+    Rows with a null embedding (e.g. null source text) get null in both.
+    """
+    @pandas_udf("q binary, scale float")
+    def _quantize(embeddings: pd.Series) -> pd.DataFrame:
+        present = np.flatnonzero(embeddings.notna().to_numpy())
+        q, scale = [None] * len(embeddings), np.full(len(embeddings), np.nan, dtype=np.float32)
+        if len(present):
+            quantized, scales = quantize_embeddings(np.stack(embeddings.iloc[present].to_numpy()), method)
+            for i, row in zip(present, quantized):
+                q[i] = row.tobytes()
+            scale[present] = scales
+        return pd.DataFrame({"q": pd.Series(q, dtype=object), "scale": scale})
+
+    return (df.withColumn("_quantized", _quantize(F.col(embedding_col)))
+              .withColumn(f"{embedding_col}_q", F.col("_quantized.q"))
+              .withColumn(f"{embedding_col}_scale", F.col("_quantized.scale"))
+              .drop("_quantized"))
+
+def dequantize_embedding_column(df, embedding_col="embedding", method="int8", dim=1024):
+    """
+    Rebuild an approximate array<float> <embedding_col> from the <embedding_col>_q/_scale columns.
+    """
+    dtype = np.int8 if method == "int8" else np.uint8
+
+    @pandas_udf("array<float>")
+    def _dequantize(quantized: pd.Series, scales: pd.Series) -> pd.Series:
+        present = np.flatnonzero(quantized.notna().to_numpy())
+        embeddings = [None] * len(quantized)
+        if len(present):
+            rows = np.stack([np.frombuffer(value, dtype=dtype) for value in quantized.iloc[present]])
+            vectors = dequantize_embeddings(rows, scales.iloc[present].to_numpy(np.float32), method, dim)
+            for i, vector in zip(present, vectors):
+                embeddings[i] = vector
+        return pd.Series(embeddings, dtype=object)
+
+    return df.withColumn(embedding_col, _dequantize(F.col(f"{embedding_col}_q"), F.col(f"{embedding_col}_scale")))
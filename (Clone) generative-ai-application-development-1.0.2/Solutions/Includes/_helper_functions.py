@@ -1,5 +1,5 @@
 # Databricks notebook source
-# Function used to randomly assign each user a VS Endpoint
+# Function used to randomly assign each user a VS Endpoint (superseded by assign_vs_endpoint below)
 def get_fixed_integer(string_input):
     # Calculate the sum of ASCII values of the characters in the input string
     ascii_sum = sum(ord(char) for char in string_input)
@@ -11,6 +11,74 @@ def get_fixed_integer(string_input):
 
 # COMMAND ----------
 
+# Load-aware endpoint assignment. Users are spread over the endpoints with weighted rendezvous hashing, so
+# each user keeps the same endpoint across runs and adding or removing an endpoint only moves its share of users.
+# A user whose index already lives on an endpoint stays there. Only a new index is placed by load: endpoints
+# that already hold their capacity of indexes are skipped, and a primary that isn't ONLINE fails over.
+import hashlib
+import math
+
+def _rendezvous_score(key, endpoint_name, weight):
+    # sha256 rather than hash(), which is salted per Python process
+    digest = hashlib.sha256(f"{key}:{endpoint_name}".encode("utf-8")).digest()
+    u = (int.from_bytes(digest[:8], "big") + 1) / (2**64 + 1)  # uniform in (0, 1)
+    return -weight / math.log(u)
+
+def rank_vs_endpoints(key, capacities):
+    """
+    Order the endpoints of capacities ({name: max indexes}) by preference for key, heavier endpoints win more often.
+    """
+    return sorted((name for name, capacity in capacities.items() if capacity > 0),
+                  key=lambda name: _rendezvous_score(key, name, capacities[name]), reverse=True)
+
+def _index_endpoint(index_full_name, workspace=None):
+    # The endpoint hosting the index according to its own description, None when the index doesn't exist
+    from databricks.sdk import WorkspaceClient
+    from databricks.sdk.errors import NotFound
+    try:
+        return (workspace or WorkspaceClient()).vector_search_indexes.get_index(index_full_name).endpoint_name
+    except NotFound:
+        return None
+
+def assign_vs_endpoint(key, capacities=None, prefix="vs_endpoint_", count=9, default_capacity=50,
+                       fallback="vs_endpoint_fallback", index_names=None, vsc=None, workspace=None):
+    """
+    Pick the vector search endpoint for key (usually the user name). If one of index_names already exists,
+    the endpoint hosting it is kept whatever its load or state. Otherwise the first endpoint in the rendezvous
+    ranking that still has room for an index, or `fallback` when that endpoint isn't ONLINE.
+    capacities defaults to {prefix1..prefix<count>: default_capacity}.
+    """
+    index_names = [index_names] if isinstance(index_names, str) else list(index_names or [])
+    for index_name in index_names:
+        host = _index_endpoint(index_name, workspace)
+        if host:
+            return host
+
+    capacities = capacities or {f"{prefix}{i}": default_capacity for i in range(1, count + 1)}
+    vsc = vsc or VectorSearchClient()
+    endpoints = {e["name"]: e for e in vsc.list_endpoints().get("endpoints", [])}
+
+    def state(name):
+        return endpoints.get(name, {}).get("endpoint_status", {}).get("state", "NOT_FOUND").upper()
+
+    ranking = rank_vs_endpoints(key, capacities)
+    if not ranking:
+        if not fallback:
+            raise ValueError(f"No vector search endpoint has capacity for an index: {capacities}")
+        print(f"No endpoint in {sorted(capacities)} has capacity for an index, using the fallback endpoint {fallback}.")
+        return fallback
+    primary = next((name for name in ranking if endpoints.get(name, {}).get("num_indexes", 0) < capacities[name]),
+                   ranking[0])
+    if "ONLINE" in state(primary):
+        return primary
+    if fallback and "ONLINE" in state(fallback):
+        print(f"Endpoint {primary} is {state(primary)}, using the fallback endpoint {fallback}.")
+        return fallback
+    print(f"Endpoint {primary} is {state(primary)} and the fallback {fallback} is {state(fallback)}, keeping {primary}.")
+    return primary
+
+# COMMAND ----------
+
 import time
 import re
 import io
@@ -29,37 +97,105 @@ def index_exists(vsc, endpoint_name, index_full_name):
           raise e
   return False
 
-def wait_for_vs_endpoint_to_be_ready(vsc, vs_endpoint_name):
-  for i in range(180):
-    endpoint = vsc.get_endpoint(vs_endpoint_name)
-    status = endpoint.get("endpoint_status", endpoint.get("status"))["state"].upper()
-    if "ONLINE" in status:
-      return endpoint
-    elif "PROVISIONING" in status or i <6:
-      if i % 20 == 0: 
-        print(f"Waiting for endpoint to be ready, this can take a few min... {endpoint}")
-      time.sleep(10)
-    else:
-      raise Exception(f'''Error with the endpoint {vs_endpoint_name}. - this shouldn't happen: {endpoint}.\n Please delete it and re-run the previous cell: vsc.delete_endpoint("{vs_endpoint_name}")''')
-  raise Exception(f"Timeout, your endpoint isn't ready yet: {vsc.get_endpoint(vs_endpoint_name)}")
+def wait_for_vs_endpoint_to_be_ready(vsc, vs_endpoint_name, timeout=1800):
+  return wait_for_vs_resources(vsc, [{"kind": "endpoint", "name": vs_endpoint_name}], timeout=timeout)[vs_endpoint_name]
+
+def wait_for_index_to_be_ready(vsc, vs_endpoint_name, index_name, timeout=1800):
+  wait_for_vs_resources(vsc, [{"kind": "index", "endpoint_name": vs_endpoint_name, "name": index_name}], timeout=timeout)
+
+# COMMAND ----------
+
+# Readiness waiter for any number of vector search endpoints and indexes at once. Each resource is polled
+# with exponential backoff and jitter until a shared deadline, and every state change is reported as an event.
+import asyncio
+import random
 
-def wait_for_index_to_be_ready(vsc, vs_endpoint_name, index_name):
-  for i in range(180):
-    idx = vsc.get_index(vs_endpoint_name, index_name).describe()
+def _vs_resource_state(vsc, resource):
+    # Returns (state, ready, failed, details) for an endpoint or index description
+    if resource["kind"] == "endpoint":
+        endpoint = vsc.get_endpoint(resource["name"])
+        state = endpoint.get("endpoint_status", endpoint.get("status"))["state"].upper()
+        return state, "ONLINE" in state, "ONLINE" not in state and "PROVISIONING" not in state, endpoint
+    idx = vsc.get_index(resource["endpoint_name"], resource["name"]).describe()
     index_status = idx.get('status', idx.get('index_status', {}))
-    status = index_status.get('detailed_state', index_status.get('status', 'UNKNOWN')).upper()
-    url = index_status.get('index_url', index_status.get('url', 'UNKNOWN'))
-    if "ONLINE" in status:
-      return
-    if "UNKNOWN" in status:
-      print(f"Can't get the status - will assume index is ready {idx} - url: {url}")
-      return
-    elif "PROVISIONING" in status:
-      if i % 40 == 0: print(f"Waiting for index to be ready, this can take a few min... {index_status} - pipeline url:{url}")
-      time.sleep(10)
-    else:
-        raise Exception(f'''Error with the index - this shouldn't happen. DLT pipeline might have been killed.\n Please delete it and re-run the previous cell: vsc.delete_index("{index_name}, {vs_endpoint_name}") \nIndex details: {idx}''')
-  raise Exception(f"Timeout, your index isn't ready yet: {vsc.get_index(index_name, vs_endpoint_name)}")
+    state = index_status.get('detailed_state', index_status.get('status', 'UNKNOWN')).upper()
+    if "UNKNOWN" in state:
+        url = index_status.get('index_url', index_status.get('url', 'UNKNOWN'))
+        print(f"Can't get the status - will assume index is ready {idx} - url: {url}")
+    ready = "ONLINE" in state or "UNKNOWN" in state
+    return state, ready, not ready and "PROVISIONING" not in state, idx
+
+def _vs_resource_error(resource, details):
+    if resource["kind"] == "endpoint":
+        return Exception(f'''Error with the endpoint {resource["name"]}. - this shouldn't happen: {details}.\n Please delete it and re-run the previous cell: vsc.delete_endpoint("{resource["name"]}")''')
+    return Exception(f'''Error with the index - this shouldn't happen. DLT pipeline might have been killed.\n Please delete it and re-run the previous cell: vsc.delete_index("{resource["name"]}, {resource["endpoint_name"]}") \nIndex details: {details}''')
+
+async def wait_for_vs_resources_async(vsc, resources, timeout=1800, initial_delay=2, max_delay=60,
+                                      failure_grace_period=60, on_event=None):
+    """
+    Wait until all resources ({"kind": "endpoint", "name": ...} or {"kind": "index", "endpoint_name": ...,
+    "name": ...}) are ready and return {name: description}. on_event is called with a dict for every state
+    transition. Endpoints may report other states during the first failure_grace_period seconds.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + timeout
+
+    def emit(resource, state, previous_state, details):
+        event = {"kind": resource["kind"], "name": resource["name"], "state": state,
+                 "previous_state": previous_state, "elapsed": round(loop.time() - started, 1), "details": details}
+        if on_event:
+            on_event(event)
+        else:
+            print(f"[{event['elapsed']:>6}s] {resource['kind']} {resource['name']}: {previous_state or 'START'} -> {state}")
+
+    async def watch(resource):
+        delay, previous_state = initial_delay, None
+        while True:
+            state, ready, failed, details = await asyncio.to_thread(_vs_resource_state, vsc, resource)
+            if state != previous_state:
+                emit(resource, state, previous_state, details)
+                previous_state = state
+            if ready:
+                return details
+            in_grace_period = resource["kind"] == "endpoint" and loop.time() - started < failure_grace_period
+            if failed and not in_grace_period:
+                raise _vs_resource_error(resource, details)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise TimeoutError(f"Timeout, your {resource['kind']} {resource['name']} isn't ready yet: {details}")
+            await asyncio.sleep(min(remaining, random.uniform(delay / 2, delay)))
+            delay = min(max_delay, delay * 2)
+
+    results = await asyncio.gather(*(watch(resource) for resource in resources), return_exceptions=True)
+    errors = [(resource, result) for resource, result in zip(resources, results) if isinstance(result, BaseException)]
+    if len(resources) == 1 and errors:
+        raise errors[0][1]
+    if errors:
+        raise Exception(f"{len(errors)} of {len(resources)} resources failed:\n" +
+                        "\n".join(f"- {resource['kind']} {resource['name']}: {error}" for resource, error in errors))
+    return {resource["name"]: result for resource, result in zip(resources, results)}
+
+def _run_async(coroutine):
+    # Notebooks may already run an event loop in this thread, in that case run the coroutine in its own thread
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+def wait_for_vs_resources(vsc, resources, **kwargs):
+    return _run_async(wait_for_vs_resources_async(vsc, resources, **kwargs))
+
+# COMMAND ----------
+
+# MAGIC %run ./_embedding_functions
+
+# COMMAND ----------
+
+# MAGIC %run ./_retrieval_functions
 
 # COMMAND ----------
 
@@ -70,68 +206,631 @@ from databricks.sdk import WorkspaceClient
 import databricks.sdk.service.catalog as c
 from databricks.vector_search.client import VectorSearchClient
 
-@pandas_udf("array<float>")
-def get_embedding(contents: pd.Series) -> pd.Series:
-    deploy_client = mlflow.deployments.get_deploy_client("databricks")
-    def get_embeddings(batch):
-        #Note: this will fail if an exception is thrown during embedding creation (add try/except if needed) 
-        response = deploy_client.predict(endpoint="databricks-bge-large-en", inputs={"input": batch})
-        return [e['embedding'] for e in response.data]
-
-    # Splitting the contents into batches of 150 items each, since the embedding model takes at most 150 inputs per request.
-    max_batch_size = 150
-    batches = [contents.iloc[i:i + max_batch_size] for i in range(0, len(contents), max_batch_size)]
+# Sequential by default, use make_get_embedding(max_in_flight=8) to keep several requests in flight per partition
+get_embedding = make_get_embedding("databricks-bge-large-en")
 
-    # Process each batch and collect the results
-    all_embeddings = []
-    for batch in batches:
-        all_embeddings += get_embeddings(batch.tolist())
-
-    return pd.Series(all_embeddings)
+# Same embeddings, streamed batch by batch with per-partition setup and the next request pipelined
+get_embedding_iter = make_get_embedding_iter("databricks-bge-large-en")
 
 def create_vs_endpoint(vs_endpoint_name):
     vsc = VectorSearchClient()
 
     # check if the endpoint exists
     if vs_endpoint_name not in [e['name'] for e in vsc.list_endpoints()['endpoints']]:
-        vsc.create_endpoint(name=VECTOR_SEARCH_ENDPOINT_NAME, endpoint_type="STANDARD")
+        vsc.create_endpoint(name=vs_endpoint_name, endpoint_type="STANDARD")
 
     # check the status of the endpoint
     wait_for_vs_endpoint_to_be_ready(vsc, vs_endpoint_name)
     print(f"Endpoint named {vs_endpoint_name} is ready.")
 
-def create_vs_index(vs_endpoint_name, vs_index_fullname, source_table_fullname, source_col):
+def create_vs_index(vs_endpoint_name, vs_index_fullname, source_table_fullname, source_col, embedding_cache_table=None,
+                    embedding_storage="float32", embedding_dimension=1024):
     #create compute endpoint
     vsc = VectorSearchClient()
     create_vs_endpoint(vs_endpoint_name)
-    
+
+    if embedding_storage not in EMBEDDING_STORAGE_TYPES:
+        raise ValueError(f"Unknown embedding_storage {embedding_storage!r}, expected one of {EMBEDDING_STORAGE_TYPES}")
+    if embedding_storage != "float32" and not embedding_cache_table:
+        raise ValueError("Quantized embedding storage needs an embedding_cache_table to keep the full-precision vectors")
+    quantized = embedding_storage != "float32"
+
+    if embedding_cache_table:
+        # Self-managed embeddings: compute them through the embedding cache into a sibling table and index that one
+        embedded_table_fullname = f"{source_table_fullname}_embedded"
+        df = add_embeddings(spark.table(source_table_fullname), source_col, cache_table=embedding_cache_table)
+        if quantized:
+            # Only the quantized vectors are stored here, the full-precision ones stay in the embedding cache
+            df = quantize_embedding_column(df, "embedding", embedding_storage).drop("embedding")
+        df.write.mode("overwrite").option("overwriteSchema", "true").saveAsTable(embedded_table_fullname)
+        spark.sql(f"""ALTER TABLE {embedded_table_fullname} SET TBLPROPERTIES (delta.enableChangeDataFeed = true,
+                      'dbacademy.embedding_storage' = '{embedding_storage}')""")
+
     # create or sync the index
     if not index_exists(vsc, vs_endpoint_name, vs_index_fullname):
         print(f"Creating index {vs_index_fullname} on endpoint {vs_endpoint_name}...")
-        
-        vsc.create_delta_sync_index(
-            endpoint_name=vs_endpoint_name,
-            index_name=vs_index_fullname,
-            source_table_name=source_table_fullname,
-            pipeline_type="TRIGGERED", #Sync needs to be manually triggered
-            primary_key="id",
-            embedding_source_column=source_col,
-            embedding_model_endpoint_name="databricks-bge-large-en"
-        )
-        
-        # vsc.create_delta_sync_index(
-        #     endpoint_name=vs_endpoint_name,
-        #     index_name=vs_index_fullname,
-        #     source_table_name=source_table_fullname,
-        #     pipeline_type="TRIGGERED", #Sync needs to be manually triggered
-        #     primary_key="id",
-        #     embedding_dimension=1024, #Match your model embedding size (bge)
-        #     embedding_vector_column="embedding"
-        # )
 
+        if not embedding_cache_table:
+            vsc.create_delta_sync_index(
+                endpoint_name=vs_endpoint_name,
+                index_name=vs_index_fullname,
+                source_table_name=source_table_fullname,
+                pipeline_type="TRIGGERED", #Sync needs to be manually triggered
+                primary_key="id",
+                embedding_source_column=source_col,
+                embedding_model_endpoint_name="databricks-bge-large-en"
+            )
+        elif not quantized:
+            vsc.create_delta_sync_index(
+                endpoint_name=vs_endpoint_name,
+                index_name=vs_index_fullname,
+                source_table_name=embedded_table_fullname,
+                pipeline_type="TRIGGERED", #Sync needs to be manually triggered
+                primary_key="id",
+                embedding_dimension=embedding_dimension, #Match your model embedding size (bge)
+                embedding_vector_column="embedding"
+            )
+        else:
+            # Vector Search only ingests array<float>, so quantized tables feed a direct access index
+            vsc.create_direct_access_index(
+                endpoint_name=vs_endpoint_name,
+                index_name=vs_index_fullname,
+                primary_key="id",
+                embedding_dimension=embedding_dimension,
+                embedding_vector_column="embedding",
+                schema={"id": "bigint", source_col: "string", "embedding": "array<float>"}
+            )
+
+        index_created = True
     else:
-        #Trigger a sync to update our vs content with the new data saved in the table
-        vsc.get_index(vs_endpoint_name, vs_index_fullname).sync()
+        index_created = False
+        if not quantized:
+            #Trigger a sync to update our vs content with the new data saved in the table
+            vsc.get_index(vs_endpoint_name, vs_index_fullname).sync()
 
     #Let's wait for the index to be ready and all our embeddings to be created and indexed
     wait_for_index_to_be_ready(vsc, vs_endpoint_name, vs_index_fullname)
+
+    if quantized:
+        # The direct access index stores the dequantized float32 vectors, so index memory is the same as float32;
+        # quantization only shrinks the embedded table
+        index = vsc.get_index(vs_endpoint_name, vs_index_fullname)
+        upsert_quantized_embeddings(index, embedded_table_fullname, source_col, embedding_storage, embedding_dimension)
+        if not index_created:
+            # Upserts never remove anything, drop the rows that are gone from the source table
+            delete_stale_index_rows(index, embedded_table_fullname)
+
+    # Cached similarity search results may predate the sync
+    invalidate_vs_result_cache(vs_index_fullname)
+
+def upsert_quantized_embeddings(index, embedded_table_fullname, source_col, embedding_storage="int8",
+                                embedding_dimension=1024, batch_size=500, df=None):
+    # Dequantize on the executors and push the vectors to a direct access index in batches. Rows without an
+    # embedding (null source text) can't be indexed, they are deleted in case an earlier version had one.
+    df = df if df is not None else spark.table(embedded_table_fullname)
+    df = dequantize_embedding_column(df.select("id", source_col, "embedding_q", "embedding_scale"),
+                                     "embedding", embedding_storage, embedding_dimension)
+    batch, missing = [], []
+    for row in df.select("id", source_col, "embedding").toLocalIterator():
+        if row["embedding"] is None:
+            missing.append(row["id"])
+            continue
+        batch.append(row.asDict())
+        if len(batch) >= batch_size:
+            index.upsert(batch)
+            batch = []
+    if batch:
+        index.upsert(batch)
+    for start in range(0, len(missing), batch_size):
+        index.delete(primary_keys=missing[start:start + batch_size])
+
+def scan_index_ids(index, id_col="id", page_size=1000):
+    # Page through a direct access index in primary key order and collect its ids
+    ids, last_primary_key = [], None
+    while True:
+        page = index.scan_index(num_results=page_size, last_primary_key=last_primary_key)
+        rows = page.get("data") or []
+        for row in rows:
+            value = next(field["value"] for field in row["fields"] if field["key"] == id_col)
+            ids.append(next(iter(value.values())))
+        last_primary_key = page.get("last_primary_key")
+        if len(rows) < page_size or not last_primary_key:
+            return ids
+
+def delete_stale_index_rows(index, embedded_table_fullname, id_col="id", batch_size=500):
+    # Delete the index rows whose id is no longer in the embedded table, returns how many were deleted
+    index_ids = {int(i) for i in scan_index_ids(index, id_col)}
+    table_ids = {row[id_col] for row in spark.table(embedded_table_fullname).select(id_col).collect()}
+    stale = sorted(index_ids - table_ids)
+    for start in range(0, len(stale), batch_size):
+        index.delete(primary_keys=stale[start:start + batch_size])
+    if stale:
+        print(f"Deleted {len(stale)} rows from {index.name} that are no longer in {embedded_table_fullname}.")
+    return len(stale)
+
+def _delta_table_version(table_fullname):
+    from delta.tables import DeltaTable
+    return DeltaTable.forName(spark, table_fullname).history(1).collect()[0]["version"]
+
+def _get_sync_checkpoint(checkpoint_table, vs_index_fullname):
+    spark.sql(f"""CREATE TABLE IF NOT EXISTS {checkpoint_table}
+                  (index_name STRING, source_table STRING, version BIGINT, updated_at TIMESTAMP)""")
+    rows = spark.table(checkpoint_table).where(F.col("index_name") == vs_index_fullname).select("version").collect()
+    return rows[0]["version"] if rows else None
+
+def _set_sync_checkpoint(checkpoint_table, vs_index_fullname, source_table_fullname, version):
+    from delta.tables import DeltaTable
+    checkpoint = spark.createDataFrame([(vs_index_fullname, source_table_fullname, version)],
+                                       "index_name string, source_table string, version bigint")
+    (DeltaTable.forName(spark, checkpoint_table).alias("c")
+        .merge(checkpoint.withColumn("updated_at", F.current_timestamp()).alias("n"), "c.index_name = n.index_name")
+        .whenMatchedUpdateAll()
+        .whenNotMatchedInsertAll()
+        .execute())
+
+def sync_vs_index_incremental(vs_endpoint_name, vs_index_fullname, source_table_fullname, source_col, embedding_cache_table,
+                              checkpoint_table=None, embedding_storage="float32", embedding_dimension=1024):
+    """
+    Bring a self-managed index up to date from the source table's Change Data Feed: only rows inserted or
+    updated since the last checkpointed version are embedded, deleted rows are removed, and the processed
+    version is recorded in checkpoint_table. Falls back to a full create_vs_index when there is no usable
+    checkpoint (first run, CDF not readable from that version) or when the source table's schema no longer
+    matches the embedded table.
+    """
+    from functools import reduce
+    from delta.tables import DeltaTable
+    from pyspark.sql.window import Window
+
+    checkpoint_table = checkpoint_table or f"{source_table_fullname.rsplit('.', 1)[0]}.vs_sync_checkpoints"
+    embedded_table_fullname = f"{source_table_fullname}_embedded"
+    last_version = _get_sync_checkpoint(checkpoint_table, vs_index_fullname)
+    current_version = _delta_table_version(source_table_fullname)
+
+    changes = None
+    if last_version is not None and spark.catalog.tableExists(embedded_table_fullname):
+        if last_version >= current_version:
+            print(f"Index {vs_index_fullname} is up to date with {source_table_fullname} version {current_version}.")
+            return
+        # The read is materialized here: versions lost to VACUUM or log retention and ranges without CDF only
+        # fail once the data is read, and the changes are used several times below
+        try:
+            changes = (spark.read.format("delta")
+                       .option("readChangeFeed", "true")
+                       .option("startingVersion", last_version + 1)
+                       .option("endingVersion", current_version)
+                       .table(source_table_fullname)
+                       .localCheckpoint())
+        except Exception as e:
+            print(f"Can't read the change data feed of {source_table_fullname} since version {last_version + 1}, doing a full sync: {e}")
+            changes = None
+
+    if changes is not None:
+        # The embedded table holds the source columns plus the embedding ones, a column added, dropped or
+        # retyped in the source since then can't be merged into it
+        embedding_columns = {"embedding", "embedding_q", "embedding_scale"}
+        source_schema = {f.name: f.dataType for f in spark.table(source_table_fullname).schema}
+        embedded_schema = {f.name: f.dataType for f in spark.table(embedded_table_fullname).schema
+                           if f.name not in embedding_columns}
+        changed_columns = sorted(name for name in source_schema.keys() | embedded_schema.keys()
+                                 if source_schema.get(name) != embedded_schema.get(name))
+        if changed_columns:
+            print(f"The schema of {source_table_fullname} changed since the last sync ({changed_columns}), doing a full sync.")
+            changes = None
+
+    if changes is None:
+        create_vs_index(vs_endpoint_name, vs_index_fullname, source_table_fullname, source_col,
+                        embedding_cache_table=embedding_cache_table, embedding_storage=embedding_storage,
+                        embedding_dimension=embedding_dimension)
+        _set_sync_checkpoint(checkpoint_table, vs_index_fullname, source_table_fullname, current_version)
+        return
+
+    # Keep the last change per id. Within one commit (e.g. an overwrite) an insert wins over a delete.
+    change_rank = F.when(F.col("_change_type") == "delete", 0).otherwise(1)
+    latest = (changes.where(F.col("_change_type") != "update_preimage")
+              .withColumn("_rank", F.row_number().over(Window.partitionBy("id")
+                                                        .orderBy(F.col("_commit_version").desc(), change_rank.desc())))
+              .where("_rank = 1"))
+    source_columns = [c for c in changes.columns if not c.startswith("_")]
+    upserts = latest.where(F.col("_change_type") != "delete").select(*source_columns)
+    deletes = latest.where(F.col("_change_type") == "delete").select("id")
+
+    # Only rows whose content changed are embedded and written, unchanged re-inserts are no-ops
+    embedded = DeltaTable.forName(spark, embedded_table_fullname)
+    current = spark.table(embedded_table_fullname).select(*source_columns)
+    same_content = [upserts[c].eqNullSafe(current[c]) for c in source_columns]
+    changed = upserts.join(current, reduce(lambda left, right: left & right, same_content), "left_anti")
+    changed = add_embeddings(changed, source_col, cache_table=embedding_cache_table)
+    if embedding_storage != "float32":
+        changed = quantize_embedding_column(changed, "embedding", embedding_storage).drop("embedding")
+    changed = changed.localCheckpoint()  # embed once, used by the merge and the index upsert
+    deleted_ids = [row["id"] for row in deletes.collect()]
+
+    (embedded.alias("t")
+        .merge(changed.alias("s"), "t.id = s.id")
+        .whenMatchedUpdateAll()
+        .whenNotMatchedInsertAll()
+        .execute())
+    if deleted_ids:
+        embedded.delete(F.col("id").isin(deleted_ids))
+
+    vsc = VectorSearchClient()
+    index = vsc.get_index(vs_endpoint_name, vs_index_fullname)
+    if embedding_storage == "float32":
+        # The delta sync index picks the changes up from the embedded table's own change data feed
+        index.sync()
+        wait_for_index_to_be_ready(vsc, vs_endpoint_name, vs_index_fullname)
+    else:
+        upsert_quantized_embeddings(index, embedded_table_fullname, source_col, embedding_storage,
+                                    embedding_dimension, df=changed)
+        if deleted_ids:
+            index.delete(primary_keys=deleted_ids)
+
+    invalidate_vs_result_cache(vs_index_fullname)
+    _set_sync_checkpoint(checkpoint_table, vs_index_fullname, source_table_fullname, current_version)
+    print(f"Synced {vs_index_fullname} to {source_table_fullname} version {current_version}: "
+          f"{changed.count()} rows upserted, {len(deleted_ids)} deleted.")
+
+def similarity_search_rescored(index, query_text, source_col, embedding_cache_table, num_results=5, oversample=4,
+                               columns=None, endpoint="databricks-bge-large-en"):
+    """
+    Search a quantized index for num_results * oversample candidates, then re-rank them by exact cosine
+    similarity against their full-precision vectors from the embedding cache.
+    """
+    import numpy as np
+
+    query = _embed_texts([query_text], endpoint=endpoint, dedupe=False)[0][0]
+    columns = list(dict.fromkeys((columns or []) + ["id", source_col]))
+    results = index.similarity_search(query_vector=query.tolist(), columns=columns,
+                                      num_results=num_results * oversample)
+    names = [column["name"] for column in results["manifest"]["columns"]]
+    rows = results["result"].get("data_array") or []
+    if not rows:
+        return results
+
+    # Candidates keep their approximate score if the cache doesn't have their vector
+    keys = [embedding_cache_key(endpoint, row[names.index(source_col)]) for row in rows]
+    vectors = {r["key"]: np.asarray(r["embedding"], dtype=np.float32)
+               for r in spark.table(embedding_cache_table).where(F.col("key").isin(keys)).select("key", "embedding").collect()}
+    score_idx = names.index("score")
+    query_norm = np.linalg.norm(query) or 1.0
+    for row, key in zip(rows, keys):
+        if key in vectors:
+            row[score_idx] = float(query @ vectors[key] / (query_norm * (np.linalg.norm(vectors[key]) or 1.0)))
+    rows = sorted(rows, key=lambda row: row[score_idx], reverse=True)[:num_results]
+    results["result"]["data_array"] = rows
+    results["result"]["row_count"] = len(rows)
+    return results
+
+# COMMAND ----------
+
+# Bulk provisioning: create many endpoints and indexes with bounded concurrency and wait on all of them together
+async def provision_vector_search_async(manifest, max_concurrency=4, timeout=3600, on_event=None):
+    """
+    Create the endpoints and delta sync indexes listed in a manifest, e.g.
+    {"endpoints": ["vs_endpoint_1", ...],
+     "indexes": [{"endpoint_name": "vs_endpoint_1", "index_name": "cat.schema.idx",
+                  "source_table_name": "cat.schema.table", "embedding_source_column": "text"}]}
+    Index specs are passed to create_delta_sync_index (primary_key "id", TRIGGERED pipeline and
+    databricks-bge-large-en are the defaults); existing indexes are synced instead.
+    Returns one report row per resource with its status and timings in seconds.
+    """
+    vsc = VectorSearchClient()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    existing_endpoints = {e['name'] for e in (await asyncio.to_thread(vsc.list_endpoints)).get('endpoints', [])}
+
+    index_specs = manifest.get("indexes", [])
+    endpoint_names = [e if isinstance(e, str) else e["name"] for e in manifest.get("endpoints", [])]
+    endpoint_names += [spec["endpoint_name"] for spec in index_specs if spec["endpoint_name"] not in endpoint_names]
+    endpoint_types = {e["name"]: e.get("endpoint_type", "STANDARD") for e in manifest.get("endpoints", []) if not isinstance(e, str)}
+
+    async def provision(kind, name, create, resource):
+        report = {"kind": kind, "name": name, "status": None, "create_seconds": None, "ready_seconds": None, "error": None}
+        started = loop.time()
+        try:
+            async with semaphore:
+                report["status"] = await asyncio.to_thread(create)
+            report["create_seconds"] = round(loop.time() - started, 1)
+            await wait_for_vs_resources_async(vsc, [resource], timeout=max(0, deadline - loop.time()), on_event=on_event)
+            report["ready_seconds"] = round(loop.time() - started, 1)
+        except Exception as e:
+            report["status"], report["error"] = "failed", str(e)
+        return report
+
+    def create_endpoint(name):
+        if name in existing_endpoints:
+            return "exists"
+        vsc.create_endpoint(name=name, endpoint_type=endpoint_types.get(name, "STANDARD"))
+        return "created"
+
+    def create_index(spec):
+        if index_exists(vsc, spec["endpoint_name"], spec["index_name"]):
+            vsc.get_index(spec["endpoint_name"], spec["index_name"]).sync()
+            invalidate_vs_result_cache(spec["index_name"])
+            return "synced"
+        options = {"pipeline_type": "TRIGGERED", "primary_key": "id"}
+        if "embedding_vector_column" not in spec:
+            options["embedding_model_endpoint_name"] = "databricks-bge-large-en"
+        vsc.create_delta_sync_index(**{**options, **spec})
+        return "created"
+
+    endpoint_tasks = {name: asyncio.ensure_future(provision("endpoint", name, lambda name=name: create_endpoint(name),
+                                                            {"kind": "endpoint", "name": name}))
+                      for name in endpoint_names}
+
+    async def provision_index(spec):
+        endpoint_report = await endpoint_tasks[spec["endpoint_name"]]
+        if endpoint_report["status"] == "failed":
+            return {"kind": "index", "name": spec["index_name"], "status": "failed", "create_seconds": None,
+                    "ready_seconds": None, "error": f"endpoint {spec['endpoint_name']} failed"}
+        return await provision("index", spec["index_name"], lambda: create_index(spec),
+                               {"kind": "index", "endpoint_name": spec["endpoint_name"], "name": spec["index_name"]})
+
+    index_reports = await asyncio.gather(*(provision_index(spec) for spec in index_specs))
+    return [await task for task in endpoint_tasks.values()] + list(index_reports)
+
+def provision_vector_search(manifest, max_concurrency=4, timeout=3600, raise_on_error=True, **kwargs):
+    started = time.time()
+    reports = _run_async(provision_vector_search_async(manifest, max_concurrency=max_concurrency, timeout=timeout, **kwargs))
+    for r in reports:
+        print(f"{r['kind']:<8} {r['name']:<60} {r['status']:<8} create {r['create_seconds']}s ready {r['ready_seconds']}s"
+              + (f" - {r['error']}" if r['error'] else ""))
+    print(f"Provisioned {len(reports)} resources in {time.time() - started:.1f}s")
+    failed = [r for r in reports if r["status"] == "failed"]
+    if failed and raise_on_error:
+        raise Exception(f"{len(failed)} of {len(reports)} vector search resources failed: {[r['name'] for r in failed]}")
+    return reports
+
+# COMMAND ----------
+
+# Stable primary keys: the id of a row is derived from its natural key, so it is the same on every run
+# (monotonically_increasing_id() depends on partitioning and changes whenever the table is rewritten)
+def _stable_key(key_cols):
+    return F.to_json(F.array(*[F.col(c).cast("string") for c in key_cols]))  # keeps nulls distinct from ""
+
+def _duplicate_ids(df, key_cols, id_col="id"):
+    # Ids carried by more than one row, raises if two different keys hash to the same id
+    ids = (df.groupBy(id_col)
+             .agg(F.count(F.lit(1)).alias("rows"), F.countDistinct(_stable_key(key_cols)).alias("keys"))
+             .where("rows > 1")
+             .collect())
+    collisions = [row[id_col] for row in ids if row["keys"] > 1]
+    if collisions:
+        raise ValueError(f"Hash collision on {key_cols}: ids {collisions[:10]} are shared by different keys")
+    return [row[id_col] for row in ids]
+
+def _one_row_per_id(df, id_col="id"):
+    # Keep the same row for each id on every run
+    from pyspark.sql.window import Window
+    row_hash = F.xxhash64(*[F.col(c) for c in df.columns])
+    return (df.withColumn("_row", F.row_number().over(Window.partitionBy(id_col).orderBy(row_hash)))
+              .where("_row = 1")
+              .drop("_row"))
+
+def add_stable_id(df, key_cols, id_col="id", duplicates="error"):
+    """
+    Add a deterministic 64-bit id column hashed from the key_cols values. Raises if two different keys
+    hash to the same id. Rows repeating the same key raise too, unless duplicates="drop" keeps one of them.
+    """
+    if isinstance(key_cols, str):
+        key_cols = [key_cols]
+    df = df.withColumn(id_col, F.xxhash64(_stable_key(key_cols)))
+
+    ids = _duplicate_ids(df, key_cols, id_col)
+    if ids:
+        if duplicates != "drop":
+            raise ValueError(f"{len(ids)} values of {key_cols} appear on more than one row, add key columns or use duplicates='drop'")
+        df = _one_row_per_id(df, id_col)
+        print(f"Dropped duplicate rows for {len(ids)} values of {key_cols}")
+    return df
+
+# COMMAND ----------
+
+# Hugging Face dataset -> Delta table in a single commit: the stable id, Change Data Feed and the source revision
+# are part of the one createOrReplace, and nothing is loaded or written when that revision is already in the table.
+from contextlib import contextmanager
+
+@contextmanager
+def arrow_conversion():
+    # Arrow-enabled createDataFrame(pandas) for the duration of the block, the session's own setting is restored after
+    key = "spark.sql.execution.arrow.pyspark.enabled"
+    previous = spark.conf.get(key, None)
+    spark.conf.set(key, "true")
+    try:
+        yield
+    finally:
+        if previous is None:
+            spark.conf.unset(key)
+        else:
+            spark.conf.set(key, previous)
+
+def _hf_dataset_revision(dataset_name):
+    try:
+        from huggingface_hub import HfApi
+        return HfApi().dataset_info(dataset_name).sha
+    except Exception as e:
+        print(f"Can't look up the revision of {dataset_name} on the Hub, comparing the downloaded data instead: {e}")
+        return None
+
+def _table_property(table_fullname, key):
+    if not spark.catalog.tableExists(table_fullname):
+        return None
+    from delta.tables import DeltaTable
+    return DeltaTable.forName(spark, table_fullname).detail().first()["properties"].get(key)
+
+def load_hf_dataset_table(dataset_name, table_fullname, key_cols, split="train", columns=None,
+                          cache_dir="/dbfs/cache/", duplicates="error", streaming=False, batch_rows=50000):
+    """
+    Load a Hugging Face dataset split into table_fullname with a stable id and Change Data Feed enabled,
+    in one Delta commit. Returns False without writing when the table already holds the same dataset revision.
+    streaming=True ingests splits too large for the driver with stream_hf_dataset_table instead.
+    Rows repeating the same key_cols raise unless duplicates="drop" (see add_stable_id).
+    """
+    from datasets import load_dataset
+
+    if streaming:
+        return stream_hf_dataset_table(dataset_name, table_fullname, key_cols, split=split, columns=columns,
+                                       batch_rows=batch_rows, duplicates=duplicates) > 0
+
+    revision_property = "dbacademy.source_revision"
+    current = _table_property(table_fullname, revision_property)
+    hub_sha = _hf_dataset_revision(dataset_name)
+    if hub_sha and current == f"{dataset_name}@{hub_sha}:{split}":
+        print(f"{table_fullname} is up to date with {current}, skipping the load.")
+        return False
+
+    dataset = load_dataset(dataset_name, split=split, cache_dir=cache_dir, revision=hub_sha)
+    if columns:
+        dataset = dataset.select_columns(columns)
+    # Without the Hub sha the fingerprint of the downloaded split identifies the data
+    revision = f"{dataset_name}@{hub_sha or dataset._fingerprint}:{split}"
+    if current == revision:
+        print(f"{table_fullname} is up to date with {current}, skipping the write.")
+        return False
+
+    with arrow_conversion():
+        df = spark.createDataFrame(dataset.with_format("arrow")[:].to_pandas())
+    df = add_stable_id(df, key_cols, duplicates=duplicates)
+    (df.writeTo(table_fullname)
+       .using("delta")
+       .tableProperty("delta.enableChangeDataFeed", "true")
+       .tableProperty(revision_property, revision)
+       .createOrReplace())
+    print(f"Wrote {dataset.num_rows} rows of {revision} to {table_fullname}.")
+    return True
+
+# COMMAND ----------
+
+# Streaming ingest for splits that don't fit on the driver: the split is read with streaming=True and appended
+# in micro-batches of batch_rows rows. Each append is an idempotent Delta write (txnAppId/txnVersion) that records
+# the stream's state_dict() in the commit's userMetadata, so an interrupted ingest resumes right after the last
+# committed batch without reading the rows before it again.
+import json
+
+def _split_limit(dataset_name, split, revision=None):
+    # "train[:50%]" -> ("train", half of the train rows), streaming datasets don't support split slicing
+    match = re.fullmatch(r"(\w+)(?:\[:(\d+)(%?)\])?", split.replace(" ", ""))
+    if not match:
+        raise ValueError(f"Unsupported split {split!r} for streaming, use 'name', 'name[:N]' or 'name[:P%]'")
+    name, amount, percent = match.groups()
+    if amount is None:
+        return name, None
+    if not percent:
+        return name, int(amount)
+    from datasets import load_dataset_builder
+    splits = load_dataset_builder(dataset_name, revision=revision).info.splits
+    if not splits or name not in splits:
+        raise ValueError(f"{dataset_name} doesn't report the size of split {name!r}, use '{name}[:N]' instead")
+    return name, splits[name].num_examples * int(amount) // 100
+
+def _last_ingest_checkpoint(table_fullname, source):
+    # Most recent commit of this ingest, unless the table was replaced after it
+    if not spark.catalog.tableExists(table_fullname):
+        return None
+    from delta.tables import DeltaTable
+    for commit in DeltaTable.forName(spark, table_fullname).history().select("operation", "userMetadata").collect():
+        try:
+            metadata = json.loads(commit["userMetadata"] or "{}")
+        except ValueError:
+            metadata = {}
+        if isinstance(metadata, dict) and metadata.get("source") == source:
+            return metadata
+        if "REPLACE" in commit["operation"] or commit["operation"] == "CREATE TABLE":
+            return None
+    return None
+
+def _stream_schema(stream, first_batch):
+    # Spark schema of the stream's declared features, so a batch whose column is all null keeps its type
+    import pyarrow as pa
+    from pyspark.sql.pandas.types import from_arrow_schema
+    if stream.features is not None:
+        arrow_schema = stream.features.arrow_schema
+    else:
+        arrow_schema = pa.Table.from_pandas(first_batch, preserve_index=False).schema
+    return from_arrow_schema(pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f
+                                        for f in arrow_schema]))
+
+def stream_hf_dataset_table(dataset_name, table_fullname, key_cols, split="train", columns=None, batch_rows=50000,
+                            max_batches=None, duplicates="error"):
+    """
+    Append a Hugging Face dataset split to table_fullname in micro-batches of batch_rows rows, with a stable id
+    and Change Data Feed enabled. A new ingest replaces the table, an interrupted one resumes after its last
+    committed batch. Keys repeated across batches are checked once the split is fully ingested, with the same
+    duplicates policy as add_stable_id. Returns the number of rows appended by this call.
+    """
+    from datasets import load_dataset
+    from delta.tables import DeltaTable
+
+    key_cols = [key_cols] if isinstance(key_cols, str) else key_cols
+    hub_sha = _hf_dataset_revision(dataset_name)
+    split_name, limit = _split_limit(dataset_name, split, hub_sha)
+    source = f"{dataset_name}@{hub_sha}:{split}"
+    stream = load_dataset(dataset_name, split=split_name, streaming=True, revision=hub_sha)
+    if columns:
+        stream = stream.select_columns(columns)
+    if limit is not None:
+        stream = stream.take(limit)
+    resumable = hasattr(stream, "state_dict")  # datasets >= 2.18
+
+    checkpoint = _last_ingest_checkpoint(table_fullname, source)
+    if checkpoint:
+        batch, rows_read, base_version = checkpoint["batch"] + 1, checkpoint["rows"], checkpoint["base_version"]
+        if resumable and checkpoint.get("state"):
+            stream.load_state_dict(checkpoint["state"])
+        else:
+            stream = stream.skip(rows_read)
+        schema = spark.table(table_fullname).drop("id").schema
+        print(f"Resuming the ingest of {source} into {table_fullname} after batch {batch - 1} ({rows_read} rows).")
+    else:
+        batch, rows_read, base_version, schema = 0, 0, None, None
+
+    started, rows_appended, exhausted = time.time(), 0, True
+    for records in stream.iter(batch_size=batch_rows):
+        if max_batches is not None and batch >= max_batches:
+            exhausted = False
+            break
+        state = stream.state_dict() if resumable else None  # position right after this batch
+        records = pd.DataFrame(records)
+        schema = schema or _stream_schema(stream, records)
+        with arrow_conversion():
+            df = spark.createDataFrame(records, schema)
+        df = add_stable_id(df, key_cols, duplicates=duplicates)
+        if base_version is None:
+            # First batch of a new ingest: start from an empty table with the final schema and properties
+            (DeltaTable.createOrReplace(spark)
+                .tableName(table_fullname)
+                .addColumns(df.schema)
+                .property("delta.enableChangeDataFeed", "true")
+                .execute())
+            base_version = _delta_table_version(table_fullname)
+
+        metadata = {"source": source, "batch": batch, "rows": rows_read + len(records), "base_version": base_version,
+                    "state": state}
+        (df.write.format("delta")
+           .mode("append")
+           .option("txnAppId", f"hf_ingest:{source}:{base_version}")  # a batch that already committed is skipped
+           .option("txnVersion", batch)
+           .option("userMetadata", json.dumps(metadata))
+           .saveAsTable(table_fullname))
+        rows_read += len(records)
+        rows_appended += len(records)
+        batch += 1
+        print(f"Batch {batch - 1}: {rows_read} rows of {source} in {time.time() - started:.1f}s")
+
+    if exhausted and base_version is not None:
+        # Each batch only deduplicates itself, keys repeated across batches are resolved in one pass at the end
+        table = spark.table(table_fullname)
+        ids = _duplicate_ids(table, key_cols)
+        if ids and duplicates != "drop":
+            raise ValueError(f"{len(ids)} values of {key_cols} appear in more than one batch of {table_fullname}, "
+                             f"add key columns or use duplicates='drop'")
+        if ids:
+            (_one_row_per_id(table.where(F.col("id").isin(ids))).write.format("delta")
+                .mode("overwrite")
+                .option("replaceWhere", f"id IN ({', '.join(str(i) for i in ids)})")
+                .saveAsTable(table_fullname))
+            print(f"Dropped duplicate rows for {len(ids)} values of {key_cols}")
+
+    print(f"Ingested {rows_read} rows of {source} into {table_fullname}, {rows_appended} in this run.")
+    return rows_appended
@@ -0,0 +1,792 @@
+# Databricks notebook source
+# In-process approximate nearest neighbour search. An inverted file index (IVF) over L2-normalized float32
+# vectors: k-means centroids split the vectors into lists and a query only scans the nprobe closest lists.
+# Small collections are scanned exhaustively, which is exact and still faster than a network round-trip.
+import numpy as np
+import pandas as pd
+
+def _normalize_rows(vectors):
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+def _kmeans(vectors, n_lists, iterations=10, sample_size=None, seed=0):
+    # Spherical k-means on a sample, centroids stay unit length so dot products rank them
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), sample_size or n_lists * 64)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=n_lists)
+        centroids[counts > 0] = sums[counts > 0]  # empty lists keep their previous centroid
+        centroids = _normalize_rows(centroids)
+    return centroids
+
+class IVFIndex:
+    """
+    Cosine-similarity ANN index. Collections smaller than exact_below are searched exhaustively;
+    larger ones are split into n_lists (default sqrt(n)) lists of which nprobe are scanned per query.
+    """
+    def __init__(self, vectors, n_lists=None, nprobe=8, exact_below=4096, seed=0):
+        self.vectors = _normalize_rows(vectors)
+        self.nprobe = nprobe
+        self.centroids = None
+        count = len(self.vectors)
+        if count >= exact_below:
+            n_lists = n_lists or max(1, int(np.sqrt(count)))
+            self.centroids = _kmeans(self.vectors, n_lists, seed=seed)
+            assignments = np.concatenate([np.argmax(chunk @ self.centroids.T, axis=1)
+                                          for chunk in np.array_split(self.vectors, max(1, count // 65536))])
+            # Lists are stored contiguously: list c holds self.order[self.offsets[c]:self.offsets[c + 1]]
+            self.order = np.argsort(assignments, kind="stable")
+            self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def probe_fraction(self):
+        # Share of the vectors a query scans
+        return 1.0 if self.centroids is None else min(1.0, self.nprobe / len(self.centroids))
+
+    def _candidates(self, centroid_scores, nprobe):
+        lists = np.argsort(-centroid_scores)[:nprobe]
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists])
+
+    def search(self, queries, k=5, nprobe=None, positions=None):
+        """
+        Return (ids, similarities), both (len(queries), k); missing neighbours have id -1.
+        positions restricts an exhaustive search to those vectors (pre-filtering).
+        """
+        queries = _normalize_rows(queries)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        # All queries are scored against the centroids (or every candidate when exhaustive) with one matrix product
+        exhaustive = self.centroids is None or positions is not None
+        if positions is None and exhaustive:
+            positions = np.arange(len(self.vectors))
+        batch_scores = queries @ (self.vectors[positions] if exhaustive else self.centroids).T
+        for row, query in enumerate(queries):
+            candidates = positions if exhaustive else self._candidates(batch_scores[row], nprobe or self.nprobe)
+            scores = batch_scores[row] if exhaustive else self.vectors[candidates] @ query
+            top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k] if len(scores) > k else np.arange(len(scores))
+            top = top[np.argsort(-scores[top], kind="stable")]
+            ids[row, :len(top)] = candidates[top]
+            similarities[row, :len(top)] = scores[top]
+        return ids, similarities
+
+# COMMAND ----------
+
+# Metadata filtering with the Databricks filter syntax: {"category": "Lighting"}, {"category": ["A", "B"]},
+# {"category NOT": "A"}, {"price >=": 10}, {"text LIKE": "lamp"} and {"col1 OR col2": [v1, v2]}; keys are ANDed.
+# Scalar columns are factorized once, so equality filters compare small integer codes instead of values.
+_FILTER_OPERATORS = ("NOT", "<=", ">=", "<", ">", "LIKE")
+
+def _parse_filter_key(key):
+    parts = key.strip().rsplit(" ", 1)
+    if len(parts) == 2 and parts[1].upper() in _FILTER_OPERATORS:
+        return parts[0].strip(), parts[1].upper()
+    return key.strip(), "="
+
+class MetadataIndex:
+    """
+    Filter masks over the scalar columns of a pandas DataFrame.
+    """
+    def __init__(self, frame, columns=None):
+        self.size = len(frame)
+        columns = columns or [c for c in frame.columns
+                              if not frame[c].map(lambda value: isinstance(value, (list, tuple, np.ndarray, bytes, dict))).any()]
+        self.series = {c: frame[c].reset_index(drop=True) for c in columns}
+        self.codes, self.lookup = {}, {}
+        for c in columns:
+            codes, uniques = pd.factorize(frame[c])
+            self.codes[c] = codes.astype(np.int32)
+            self.lookup[c] = {value: code for code, value in enumerate(uniques)}
+
+    def columns(self, filters):
+        return {_parse_filter_key(column)[0] for key in filters for column in key.split(" OR ")}
+
+    def supports(self, filters):
+        return self.columns(filters) <= set(self.series)
+
+    def _condition(self, column, operator, value):
+        if operator in ("=", "NOT"):
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            codes = [self.lookup[column][v] for v in values if v in self.lookup[column]]
+            matches = np.isin(self.codes[column], codes)
+            return ~matches & (self.codes[column] >= 0) if operator == "NOT" else matches
+        series = self.series[column]
+        if operator == "LIKE":
+            return series.astype("string").str.contains(str(value), case=False, regex=False).fillna(False).to_numpy(bool)
+        compare = {"<": series.lt, "<=": series.le, ">": series.gt, ">=": series.ge}[operator]
+        return compare(value).fillna(False).to_numpy(bool)
+
+    def mask(self, filters):
+        mask = np.ones(self.size, dtype=bool)
+        for key, value in (filters or {}).items():
+            if " OR " in key:
+                alternatives = np.zeros(self.size, dtype=bool)
+                for column_key, column_value in zip(key.split(" OR "), value):
+                    alternatives |= self._condition(*_parse_filter_key(column_key), column_value)
+                mask &= alternatives
+            else:
+                mask &= self._condition(*_parse_filter_key(key), value)
+        return mask
+
+def plan_filtered_search(selectivity, probe_fraction):
+    """
+    "prefilter" scans only the matching vectors (cost ~ selectivity). "postfilter" runs the ANN search with
+    nprobe and k scaled by 1 / selectivity to keep recall (cost ~ probe_fraction / selectivity) and drops
+    non-matching hits. Pre-filtering is cheaper when selectivity <= sqrt(probe_fraction).
+    """
+    return "prefilter" if selectivity <= np.sqrt(probe_fraction) else "postfilter"
+
+# COMMAND ----------
+
+# Local mirror of a vector search index. It subclasses VectorSearchIndex and answers describe() and
+# similarity_search() with the same response shape, so DatabricksVectorSearch and its retrievers accept it.
+try:
+    from databricks.vector_search.client import VectorSearchIndex
+except ImportError:
+    VectorSearchIndex = object  # offline runs without the vector search client
+
+class LocalVectorSearchIndex(VectorSearchIndex):
+    """
+    In-process copy of a delta sync index. Use LocalVectorSearchIndex.mirror(remote_index) to load the
+    index's source table, or from_pandas() to build one offline. Filters on the mirrored columns are
+    answered locally; queries the local index can't serve (filters on other columns, other query types)
+    go to remote_index when fallback is True.
+    """
+    def __init__(self, description, rows, vectors, backend=None, remote_index=None, fallback=True,
+                 source_version=None, embedding_cache_table=None, **ivf_options):
+        self.description = description
+        self.rows = rows.reset_index(drop=True)
+        self.ivf = IVFIndex(vectors, **ivf_options)
+        self.ivf_options = ivf_options
+        self.backend = backend
+        self.remote_index = remote_index
+        self.fallback = fallback
+        self.source_version = source_version
+        self.embedding_cache_table = embedding_cache_table
+        self.metadata = MetadataIndex(self.rows)
+        self.stats = {"local": 0, "remote": 0, "prefilter": 0, "postfilter": 0}
+
+    @staticmethod
+    def _pop_vectors(pdf, embedding_col):
+        # Rows without a vector (null source text) can't be searched, they are dropped to keep rows and vectors aligned
+        embeddings = pdf.pop(embedding_col)
+        present = embeddings.notna().to_numpy()
+        if not present.all():
+            print(f"Skipping {int((~present).sum())} rows without a vector in {embedding_col}")
+            pdf, embeddings = pdf[present], embeddings[present]
+        vectors = np.stack(embeddings.to_numpy()) if len(pdf) else np.zeros((0, 1), dtype=np.float32)
+        return pdf, vectors
+
+    @staticmethod
+    def _embedding_spec(description):
+        spec = description.get("delta_sync_index_spec") or description.get("direct_access_index_spec") or {}
+        source_columns = spec.get("embedding_source_columns") or []
+        vector_columns = spec.get("embedding_vector_columns") or []
+        return spec, (source_columns[0] if source_columns else None), (vector_columns[0] if vector_columns else None)
+
+    @classmethod
+    def mirror(cls, remote_index, backend=None, embedding_cache_table=None, fallback=True, **ivf_options):
+        """
+        Load the source table of a delta sync index. Self-managed indexes bring their vectors, managed ones
+        are embedded with their model endpoint (through embedding_cache_table when given) or with backend.
+        """
+        description = remote_index.describe()
+        spec, source_column, vector_column = cls._embedding_spec(description)
+        source_table = spec.get("source_table")
+        if not source_table:
+            raise ValueError(f"Only delta sync indexes can be mirrored, {description.get('name')} has no source table")
+
+        df = spark.table(source_table)
+        if vector_column:
+            embedding_col = vector_column["name"]
+        else:
+            embedding_col = "_embedding"
+            backend = backend or ServingEndpointBackend(source_column["embedding_model_endpoint_name"])
+            df = add_embeddings(df, source_column["name"], embedding_col, cache_table=embedding_cache_table, backend=backend)
+        pdf = df.toPandas()
+        pdf, vectors = cls._pop_vectors(pdf, embedding_col)
+        print(f"Mirrored {len(pdf)} rows of {source_table} for index {description.get('name')}")
+        return cls(description, pdf, vectors, backend=backend, remote_index=remote_index, fallback=fallback,
+                   source_version=_delta_table_version(source_table), embedding_cache_table=embedding_cache_table,
+                   **ivf_options)
+
+    @classmethod
+    def from_pandas(cls, pdf, primary_key, text_column, embedding_column=None, backend=None,
+                    name="local_index", **ivf_options):
+        """
+        Offline index over a pandas DataFrame, embedding text_column with backend unless embedding_column is given.
+        """
+        backend = backend or HashingEmbeddingBackend()
+        pdf = pdf.copy()
+        if embedding_column:
+            pdf, vectors = cls._pop_vectors(pdf, embedding_column)
+        else:
+            vectors, _ = _embed_texts(pdf[text_column].tolist(), backend=backend)
+        description = {
+            "name": name,
+            "primary_key": primary_key,
+            "index_type": "DELTA_SYNC",
+            "delta_sync_index_spec": {
+                "embedding_source_columns": [{"name": text_column, "embedding_model_endpoint_name": backend.name}],
+            },
+        }
+        return cls(description, pdf, vectors, backend=backend, fallback=False, **ivf_options)
+
+    def describe(self):
+        return self.description
+
+    def refresh(self):
+        # Rebuild from the source table when it has a new version since the last mirror
+        spec, _, _ = self._embedding_spec(self.description)
+        if self.remote_index is None or _delta_table_version(spec["source_table"]) == self.source_version:
+            return self
+        fresh = self.mirror(self.remote_index, backend=self.backend, embedding_cache_table=self.embedding_cache_table,
+                            fallback=self.fallback, **self.ivf_options)
+        self.__dict__.update(fresh.__dict__)
+        return self
+
+    def _remote_search(self, reason, **kwargs):
+        if not (self.fallback and self.remote_index is not None):
+            raise NotImplementedError(f"The local index can't serve this query ({reason}) and has no remote fallback")
+        self.stats["remote"] += 1
+        return self.remote_index.similarity_search(**kwargs)
+
+    def similarity_search(self, columns=None, query_text=None, query_vector=None, filters=None, num_results=5,
+                          query_type=None, **kwargs):
+        if (filters and not self.metadata.supports(filters)) or kwargs or (query_type or "ANN").upper() != "ANN":
+            return self._remote_search("filters or query options", columns=columns, query_text=query_text,
+                                       query_vector=query_vector, filters=filters, num_results=num_results,
+                                       query_type=query_type, **kwargs)
+        if query_vector is None:
+            if self.backend is None:
+                return self._remote_search("no backend to embed query_text", columns=columns, query_text=query_text,
+                                           num_results=num_results)
+            query_vector = _embed_texts([query_text], backend=self.backend, dedupe=False)[0][0]
+
+        return self.similarity_search_batch([query_vector], columns=columns, num_results=num_results, filters=filters)[0]
+
+    def similarity_search_batch(self, query_vectors, columns=None, num_results=5, filters=None):
+        """
+        One response per query vector, all queries are searched in one IVFIndex.search call.
+        """
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        if filters:
+            ids, similarities = self._filtered_search(query_vectors, num_results, filters)
+        else:
+            ids, similarities = self.ivf.search(query_vectors, num_results)
+        columns = list(columns) if columns else list(self.rows.columns)
+        self.stats["local"] += len(ids)
+        return [self._response(row_ids, row_similarities, columns) for row_ids, row_similarities in zip(ids, similarities)]
+
+    def _filtered_search(self, query_vectors, num_results, filters):
+        mask = self.metadata.mask(filters)
+        selectivity = mask.mean() if len(mask) else 0.0
+        plan = plan_filtered_search(selectivity, self.ivf.probe_fraction)
+        self.stats[plan] += len(query_vectors)
+        if plan == "prefilter" or selectivity == 0:
+            return self.ivf.search(query_vectors, num_results, positions=np.flatnonzero(mask))
+
+        oversample = 1.0 / selectivity
+        ids, similarities = self.ivf.search(query_vectors, int(np.ceil(num_results * oversample)),
+                                            nprobe=int(np.ceil(self.ivf.nprobe * oversample)))
+        keep = (ids >= 0) & mask[np.maximum(ids, 0)]
+        filtered_ids = np.full((len(ids), num_results), -1, dtype=np.int64)
+        filtered_similarities = np.full((len(ids), num_results), -np.inf, dtype=np.float32)
+        for row in range(len(ids)):
+            row_ids, row_similarities = ids[row][keep[row]][:num_results], similarities[row][keep[row]][:num_results]
+            if len(row_ids) < num_results and len(row_ids) < mask.sum():
+                # Not enough matches among the probed lists, fall back to scanning all matching vectors
+                exact_ids, exact_similarities = self.ivf.search(query_vectors[row:row + 1], num_results,
+                                                                positions=np.flatnonzero(mask))
+                row_ids, row_similarities = exact_ids[0][exact_ids[0] >= 0], exact_similarities[0][exact_ids[0] >= 0]
+            filtered_ids[row, :len(row_ids)] = row_ids
+            filtered_similarities[row, :len(row_ids)] = row_similarities
+        return filtered_ids, filtered_similarities
+
+    def _response(self, ids, similarities, columns):
+        found = ids >= 0
+        # Same scale as the remote scores: 1 / (1 + squared L2 distance) of the normalized vectors
+        scores = 1.0 / (1.0 + (2.0 - 2.0 * similarities[found]))
+        data = self.rows.iloc[ids[found]][columns].astype(object).where(lambda frame: frame.notna(), None)
+        data_array = [values + [float(score)] for values, score in zip(data.values.tolist(), scores)]
+        return {
+            "manifest": {"column_count": len(columns) + 1,
+                         "columns": [{"name": column} for column in columns] + [{"name": "score"}]},
+            "result": {"row_count": len(data_array), "data_array": data_array},
+        }
+
+def mirror_vs_index(vs_endpoint_name, vs_index_fullname, **options):
+    """
+    LocalVectorSearchIndex for an existing index, e.g. DatabricksVectorSearch(mirror_vs_index(endpoint, index)).
+    """
+    return LocalVectorSearchIndex.mirror(VectorSearchClient().get_index(vs_endpoint_name, vs_index_fullname), **options)
+
+# COMMAND ----------
+
+# Query-result cache. Wrapping the index caches both direct similarity_search calls and DatabricksVectorSearch,
+# which only calls index.similarity_search. Entries are evicted least recently used beyond max_entries and
+# expire after ttl_seconds. Each index name has a generation in the process-wide state that is part of every
+# key, so invalidate_vs_result_cache() (called when an index is synced) drops stale results in every cache.
+import copy
+import json
+from collections import OrderedDict
+
+def _vs_index_generations():
+    state = _embedding_worker_state()
+    with state.lock:
+        if not hasattr(state, "vs_index_generations"):
+            state.vs_index_generations = {}
+        return state.vs_index_generations
+
+def invalidate_vs_result_cache(index_name):
+    generations = _vs_index_generations()
+    generations[index_name] = generations.get(index_name, 0) + 1
+
+class CachedVectorSearchIndex(VectorSearchIndex):
+    """
+    Wraps a vector search index (remote or local) with an LRU + TTL cache of similarity_search results,
+    keyed by normalized query text (or the query vector), columns, filters, num_results and other options.
+    """
+    def __init__(self, index, max_entries=1024, ttl_seconds=300):
+        self.index = index
+        self.index_name = getattr(index, "name", None) or index.describe().get("name")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+    def _key(self, *parts):
+        generation = _vs_index_generations().get(self.index_name, 0)
+        return json.dumps([self.index_name, generation, *parts], sort_keys=True, default=str)
+
+    def get_or_compute(self, key, compute):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now - entry[0] < self.ttl_seconds:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return copy.deepcopy(entry[1])
+            self.stats["misses"] += 1
+        value = compute()
+        with self.lock:
+            self.entries[key] = (now, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return copy.deepcopy(value)  # callers may modify the results they get back
+
+    def similarity_search(self, columns=None, query_text=None, query_vector=None, filters=None, num_results=5, **kwargs):
+        query = normalize_embedding_text(query_text) if query_text is not None else None
+        vector = None if query_vector is None else np.round(np.asarray(query_vector, dtype=np.float32), 6).tolist()
+        key = self._key("search", query, vector, list(columns or []), filters, num_results, kwargs)
+        return self.get_or_compute(key, lambda: self.index.similarity_search(
+            columns=columns, query_text=query_text, query_vector=query_vector, filters=filters,
+            num_results=num_results, **kwargs))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def describe(self):
+        return self.index.describe()
+
+    def sync(self):
+        invalidate_vs_result_cache(self.index_name)
+        return self.index.sync()
+
+    def upsert(self, *args, **kwargs):
+        invalidate_vs_result_cache(self.index_name)
+        return self.index.upsert(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        invalidate_vs_result_cache(self.index_name)
+        return self.index.delete(*args, **kwargs)
+
+class _CachedQueryEmbeddings(Embeddings):
+    # Self-managed indexes embed the query in DatabricksVectorSearch before searching, cache that too
+    def __init__(self, embeddings, cache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        key = json.dumps(["embed_query", normalize_embedding_text(text)])
+        return self.cache.get_or_compute(key, lambda: self.embeddings.embed_query(text))
+
+def cache_vector_store(vectorstore, max_entries=1024, ttl_seconds=300):
+    """
+    Add the result cache to a DatabricksVectorSearch in place, e.g. cache_vector_store(DatabricksVectorSearch(index)).
+    """
+    vectorstore.index = CachedVectorSearchIndex(vectorstore.index, max_entries=max_entries, ttl_seconds=ttl_seconds)
+    if getattr(vectorstore, "embeddings", None) is not None:
+        vectorstore.embeddings = _CachedQueryEmbeddings(vectorstore.embeddings, vectorstore.index)
+    return vectorstore
+
+# COMMAND ----------
+
+# Hybrid retrieval. A BM25 inverted index over the same Delta table catches exact product names, model
+# numbers and SKUs that embeddings blur, and reciprocal rank fusion merges its ranking with the vector
+# search ranking without having to calibrate BM25 scores against similarity scores.
+import math
+import re
+from collections import Counter
+from typing import Any
+
+_BM25_TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*")
+
+def bm25_tokenize(text):
+    # "XR-200 lamp" -> ["xr-200", "xr", "200", "lamp"], so SKUs match whole or by their parts
+    tokens = []
+    for token in _BM25_TOKEN_PATTERN.findall((text or "").lower()):
+        tokens.append(token)
+        parts = re.split(r"[-./]", token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+class BM25Index:
+    """
+    Okapi BM25 over a list of texts, postings are kept as NumPy arrays per term.
+    """
+    def __init__(self, texts, k1=1.2, b=0.75):
+        self.k1 = k1
+        postings = {}
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for doc, text in enumerate(texts):
+            counts = Counter(bm25_tokenize(text))
+            lengths[doc] = sum(counts.values())
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((doc, tf))
+        self.postings = {term: (np.array([d for d, _ in docs], dtype=np.int64), np.array([tf for _, tf in docs], dtype=np.float32))
+                         for term, docs in postings.items()}
+        self.idf = {term: math.log(1 + (len(texts) - len(docs) + 0.5) / (len(docs) + 0.5)) for term, docs in postings.items()}
+        average_length = lengths.mean() if len(texts) else 1.0
+        self.length_norm = k1 * (1 - b + b * lengths / (average_length or 1.0))
+
+    def __len__(self):
+        return len(self.length_norm)
+
+    def search(self, query, k=20):
+        """
+        Return (document positions, scores) of the k best matching documents, documents without any query term are left out.
+        """
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(bm25_tokenize(query)):
+            if term in self.postings:
+                docs, tfs = self.postings[term]
+                scores[docs] += self.idf[term] * tfs * (self.k1 + 1) / (tfs + self.length_norm[docs])
+        matches = np.flatnonzero(scores)
+        top = matches[np.argsort(-scores[matches], kind="stable")[:k]]
+        return top, scores[top]
+
+def reciprocal_rank_fusion(rankings, k=60, weights=None):
+    """
+    Fuse ranked lists of keys, score(key) = sum(weight / (k + rank)). Returns [(key, score)] best first.
+    """
+    weights = weights or [1.0] * len(rankings)
+    fused = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, key in enumerate(ranking, start=1):
+            fused[key] = fused.get(key, 0.0) + weight / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+def _document_key(value):
+    # Search responses are JSON, so an integer primary key can come back as 12.0
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        value = int(value)
+    return str(value)
+
+try:
+    from langchain_core.documents import Document
+    from langchain_core.retrievers import BaseRetriever
+except ImportError:
+    BaseRetriever, Document = object, None  # LangChain is only installed by the notebooks that use it
+
+class HybridRetriever(BaseRetriever):
+    """
+    LangChain retriever fusing vectorstore.similarity_search with BM25 over `documents`; both fetch fetch_k
+    candidates and the k best by reciprocal rank fusion are returned, with their fused score in metadata.
+    filters (Databricks filter syntax) scope both searches, e.g. retriever.with_filters({"category": "Lighting"}).
+    """
+    vectorstore: Any
+    bm25: Any
+    documents: list
+    metadata_index: Any = None
+    filters: dict = None
+    id_key: str = "id"
+    k: int = 4
+    fetch_k: int = 20
+    rrf_k: int = 60
+    weights: tuple = (1.0, 1.0)
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def with_filters(self, filters):
+        return self.copy(update={"filters": filters})
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        if self.filters:
+            vector_docs = self.vectorstore.similarity_search(query, k=self.fetch_k, filters=self.filters)
+            # BM25 keeps scoring every document, the mask prunes the non-matching ones before ranking
+            allowed = self.metadata_index.mask(self.filters)
+            positions = [p for p in self.bm25.search(query, len(self.documents))[0] if allowed[p]][:self.fetch_k]
+        else:
+            vector_docs = self.vectorstore.similarity_search(query, k=self.fetch_k)
+            positions = self.bm25.search(query, self.fetch_k)[0]
+        keyword_docs = [self.documents[position] for position in positions]
+
+        def key(doc):
+            return _document_key(doc.metadata.get(self.id_key, doc.page_content))
+
+        by_key = {}
+        for doc in vector_docs + keyword_docs:
+            by_key.setdefault(key(doc), doc)
+        fused = reciprocal_rank_fusion([[key(doc) for doc in vector_docs], [key(doc) for doc in keyword_docs]],
+                                       k=self.rrf_k, weights=self.weights)
+        return [Document(page_content=by_key[doc_key].page_content, metadata={**by_key[doc_key].metadata, "rrf_score": score})
+                for doc_key, score in fused[:self.k]]
+
+def hybrid_retriever(vectorstore, source_table_fullname, text_col="text", id_col="id", k=4, fetch_k=20, weights=(1.0, 1.0),
+                     filters=None):
+    """
+    Drop-in for vectorstore.as_retriever(search_kwargs={"k": k}) that adds BM25 over source_table_fullname.
+    """
+    from pyspark.sql.types import ArrayType, BinaryType
+
+    df = spark.table(source_table_fullname)
+    # Embedding columns aren't useful as document metadata
+    df = df.select(*[field.name for field in df.schema.fields if not isinstance(field.dataType, (ArrayType, BinaryType))])
+    pdf = df.toPandas()
+    documents = [Document(page_content=row[text_col] or "", metadata={c: row[c] for c in pdf.columns if c != text_col})
+                 for row in pdf.to_dict("records")]
+    bm25 = BM25Index([doc.page_content for doc in documents])
+    print(f"BM25 index over {len(documents)} rows of {source_table_fullname}, {len(bm25.postings)} terms")
+    return HybridRetriever(vectorstore=vectorstore, bm25=bm25, documents=documents, id_key=id_col,
+                           metadata_index=MetadataIndex(pdf.drop(columns=[text_col])), filters=filters,
+                           k=k, fetch_k=fetch_k, weights=tuple(weights))
+
+# COMMAND ----------
+
+# Batched multi-query search: the query texts are embedded in batched calls, then a local index answers all
+# of them in one search call and a remote index gets the query vectors with max_in_flight requests in flight.
+from concurrent.futures import ThreadPoolExecutor
+
+def batch_similarity_search(index, query_texts, columns=None, num_results=5, filters=None, backend=None,
+                            max_in_flight=8, embed_queries=True, on_error="raise"):
+    """
+    Return one similarity_search response per query text, in the same order. backend defaults to the index's
+    own embedding model; embed_queries=False sends the texts to a managed-embedding index as they are.
+    With on_error="null" a failed query gives None instead of raising.
+    """
+    query_texts = list(query_texts)
+    _, source_column, _ = LocalVectorSearchIndex._embedding_spec(index.describe())
+    if embed_queries:
+        backend = backend or getattr(index, "backend", None) or ServingEndpointBackend(
+            source_column["embedding_model_endpoint_name"] if source_column else "databricks-bge-large-en")
+        query_vectors, _ = _embed_texts(query_texts, max_in_flight=min(max_in_flight, 4), backend=backend)
+        if isinstance(index, LocalVectorSearchIndex) and (not filters or index.metadata.supports(filters)):
+            return index.similarity_search_batch(query_vectors, columns=columns, num_results=num_results, filters=filters)
+        queries = [{"query_vector": vector.tolist()} for vector in query_vectors]
+    else:
+        queries = [{"query_text": text} for text in query_texts]
+
+    def search(query):
+        try:
+            return index.similarity_search(columns=columns, filters=filters, num_results=num_results, **query)
+        except Exception as e:
+            if on_error != "null":
+                raise
+            print(f"Query failed: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        return list(executor.map(search, queries))
+
+# COMMAND ----------
+
+# Paginated search. Pages are yielded as soon as they arrive; while the consumer works on one page the
+# next one is fetched in the background, and nothing past that is requested unless the consumer asks for it.
+from dataclasses import dataclass, field
+
+@dataclass
+class SimilaritySearchResult:
+    manifest: dict = field(default_factory=dict)
+    result: dict = field(default_factory=dict)
+    next_page_token: str = None
+    debug_info: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(manifest=response.get("manifest", {}), result=response.get("result", {}),
+                   next_page_token=response.get("next_page_token") or None, debug_info=response.get("debug_info", {}))
+
+    @property
+    def rows(self):
+        names = [column["name"] for column in self.manifest.get("columns", [])]
+        return [dict(zip(names, values)) for values in self.result.get("data_array") or []]
+
+def search_pages(index, query_text=None, query_vector=None, columns=None, filters=None, num_results=10,
+                 prefetch=True, max_pages=None, **kwargs):
+    """
+    Yield SimilaritySearchResult pages of num_results rows, following next_page_token with
+    index.similarity_search_next_page. With prefetch the next page is requested while the current one is processed.
+    """
+    response = index.similarity_search(columns=columns, query_text=query_text, query_vector=query_vector,
+                                       filters=filters, num_results=num_results, **kwargs)
+    page = SimilaritySearchResult.from_response(response)
+    fetch_next_page = getattr(index, "similarity_search_next_page", None)
+
+    def next_page(token):
+        return SimilaritySearchResult.from_response(fetch_next_page(page_token=token))
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    pending = None
+    try:
+        pages = 0
+        while page is not None:
+            pages += 1
+            has_next = page.next_page_token and fetch_next_page and (max_pages is None or pages < max_pages)
+            if has_next and executor:
+                pending = executor.submit(next_page, page.next_page_token)
+            yield page
+            if not has_next:
+                break
+            page = pending.result() if executor else next_page(page.next_page_token)
+    finally:
+        # The consumer may stop early, don't wait for a page nobody will read
+        if pending is not None:
+            pending.cancel()
+        if executor:
+            executor.shutdown(wait=False)
+
+def search_rows(index, query_text=None, **search_options):
+    """
+    Rows of every page as dicts, e.g. to start augmenting the first results before the later pages arrive.
+    """
+    for page in search_pages(index, query_text=query_text, **search_options):
+        yield from page.rows
+
+# COMMAND ----------
+
+# Semantic answer cache. Questions are embedded and compared with the previous questions; a paraphrase
+# above the similarity threshold gets the stored answer without running retrieval and generation again.
+# The cache holds at most max_entries questions, so an exhaustive scan of one preallocated float32 matrix
+# is both exact and faster than maintaining an IVF index.
+try:
+    from langchain_core.runnables import RunnableLambda
+except ImportError:
+    RunnableLambda = None  # LangChain is only installed by the notebooks that use it
+
+class SemanticAnswerCache:
+    """
+    Answers keyed by question embedding: lookup() returns the answer of the most similar cached question when
+    its cosine similarity is >= threshold and it is younger than ttl_seconds. When full, expired entries and then
+    the least recently used one are evicted. stats() reports hits, misses and the hit rate.
+    """
+    def __init__(self, backend=None, threshold=0.92, ttl_seconds=3600, max_entries=1000):
+        self.backend = backend or ServingEndpointBackend("databricks-bge-large-en")
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.vectors = None
+        self.questions = [None] * max_entries
+        self.answers = [None] * max_entries
+        self.created = np.zeros(max_entries)
+        self.last_used = np.zeros(max_entries)
+        self.valid = np.zeros(max_entries, dtype=bool)
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+
+    def _embed(self, question):
+        vector = _embed_texts([question], backend=self.backend, dedupe=False)[0][0]
+        return _normalize_rows(vector)[0]
+
+    def _expire(self, now):
+        expired = self.valid & (now - self.created >= self.ttl_seconds)
+        self.counts["expired"] += int(expired.sum())
+        self.valid &= ~expired
+
+    def lookup(self, question, vector=None):
+        """
+        Return (answer, similarity, cached question) for a hit, or None.
+        """
+        vector = self._embed(question) if vector is None else vector
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            if self.vectors is None or not self.valid.any():
+                self.counts["misses"] += 1
+                return None
+            similarities = np.where(self.valid, self.vectors @ vector, -np.inf)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.counts["misses"] += 1
+                return None
+            self.counts["hits"] += 1
+            self.last_used[best] = now
+            return self.answers[best], float(similarities[best]), self.questions[best]
+
+    def add(self, question, answer, vector=None):
+        vector = self._embed(question) if vector is None else vector
+        now = time.monotonic()
+        with self.lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            self._expire(now)
+            free = np.flatnonzero(~self.valid)
+            if len(free):
+                slot = int(free[0])
+            else:
+                slot = int(np.argmin(self.last_used))
+                self.counts["evictions"] += 1
+            self.vectors[slot] = vector
+            self.questions[slot], self.answers[slot] = question, answer
+            self.created[slot] = self.last_used[slot] = now
+            self.valid[slot] = True
+
+    def get_or_compute(self, question, compute):
+        vector = self._embed(question)
+        hit = self.lookup(question, vector)
+        if hit is not None:
+            return hit[0]
+        answer = compute()
+        self.add(question, answer, vector)
+        return answer
+
+    def wrap(self, chain, input_key=None):
+        """
+        Cache a chain's answers by question, e.g. cache.wrap(qa_chain, input_key="query").invoke({"query": ...}).
+        input_key picks the question from dict inputs, other inputs are used as the question themselves.
+        """
+        def invoke(inputs):
+            question = inputs[input_key] if input_key is not None else inputs
+            return self.get_or_compute(question, lambda: chain.invoke(inputs))
+        return RunnableLambda(invoke) if RunnableLambda is not None else invoke
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counts["hits"] + self.counts["misses"]
+            return {**self.counts, "entries": int(self.valid.sum()),
+                    "hit_rate": self.counts["hits"] / lookups if lookups else 0.0}
+
+    def clear(self):
+        with self.lock:
+            self.valid[:] = False